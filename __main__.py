@@ -1,12 +1,9 @@
 import logging
-from threading import Event, Thread
+from threading import Thread
 from time import sleep
 
-import userdevice
 from arg_parser import parse_args
-from iotscp.http.udpserver import UDPServer
-from iotscp.http.serializer import serialize
-from iotscp.http.deviceserver import DeviceServer
+from iotscp.utils import StopFlag
 
 try:
     input = raw_input
@@ -27,7 +24,13 @@ def config_logging(filename, loglvl):
 
 def start_server(args):
     config_logging(args.logfile, args.loglvl)
-    stop = Event()
+    # the servers and the user's device are only needed here, so don't make
+    # `get_cert` or `--help` pay for importing them
+    import userdevice
+    from iotscp.http.udpserver import UDPServer
+    from iotscp.http.serializer import serialize
+    from iotscp.http.deviceserver import DeviceServer
+    stop = StopFlag()
     device = userdevice.Device(stop)
     serialize(device)
     DeviceServer(stop, args.port, device).start()
@@ -44,7 +47,13 @@ def start_server(args):
 
 def get_cert(args):
     import iotscp.core.sccertificate
-    iotscp.core.sccertificate.generate_certificate(*args.certsize)
+    certsize = args.certsize
+    if certsize is None:
+        certsize = (
+            iotscp.core.sccertificate.DEFAULT_SEGMENTS,
+            iotscp.core.sccertificate.DEFAULT_SEGMENT_LENGTH
+        )
+    iotscp.core.sccertificate.generate_certificate(*certsize)
 
 def main():
     args = parse_args()
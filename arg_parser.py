@@ -1,8 +1,4 @@
 import argparse
-from iotscp.core.sccertificate import (
-    DEFAULT_SEGMENTS,
-    DEFAULT_SEGMENT_LENGTH
-)
 
 # LANG = "eng"
 
@@ -21,7 +17,8 @@ def parse_args():
     )
     parser.add_argument(
         "--certsize",
-        default=[DEFAULT_SEGMENTS, DEFAULT_SEGMENT_LENGTH],
+        # filled in by `get_cert` so that parsing never imports sccertificate
+        default=None,
         nargs=2,
         type=int,
         help=(
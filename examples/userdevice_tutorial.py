@@ -52,8 +52,8 @@ class Device(BaseDevice):
     pref_alg = "sha256"
     binarystate = False
 
-""" The main function takes two arguments: the device and a stop event.
-Your main loop should terminate when the stop event is set.
+""" The main function takes two arguments: the device and a stop flag.
+Your main loop should terminate when the stop flag is set.
 
 In this example, a pointer to the "Sensor" service is stored in the
 sensor_service variable. Next, device.services[sensor_service] is used
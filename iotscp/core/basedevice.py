@@ -7,7 +7,7 @@ from .scsession import get_common_algorithm, SCSession
 from ..utils import verify_str
 
 class BaseDevice():
-    """BaseDevice(stop_event, **kwargs) -> BaseDevice
+    """BaseDevice(stop_StopFlag, **kwargs) -> BaseDevice
 
     This class is the central hub of the device. It both stores information
     about the device, and handles requests made to the device
@@ -25,6 +25,9 @@ class BaseDevice():
     `services` should be an array of all the services that this device implements
     `pref_alg` is optional and should be the name of the preferred hashing
         algorithm (ex. sha256)
+
+    Service methods are run by the DeviceServer's worker threads, so a slow
+    method doesn't hold up the server, but two methods may run at once.
     """
     def __init__(self, stop, **kwargs):
         fields = (
@@ -55,10 +58,15 @@ class BaseDevice():
         self.service_events = {}
         # maybe make these lists rather than dicts and add get_method_by_name
         # to the service class (where these are already seperated into dicts)
+        # (control_url, method_name) -> method, so that a request resolves its
+        # method in a single lookup
+        self._url_method_index = {}
         for svc in self.services:
             svc.add_dispatcher(self.dispatcher)
             self.service_methods[svc.control_url] = svc
             self.service_events[svc.event_url] = svc
+            for method_name, method in svc.methods.items():
+                self._url_method_index[(svc.control_url, method_name)] = method
 
     def values_dict(self):
         """Returns a dict of device-defining data"""
@@ -102,18 +110,17 @@ class BaseDevice():
             500 in cases where an unknown error occurs
         """
         try:
-            if uuid not in self.sessions:
+            session = self.sessions.get(uuid)
+            if session is None:
                 serverclient.write_head(401)
                 return
-            session = self.sessions[uuid]
             service_url = serverclient.req.url
             body = session.decrypt(serverclient.req.body)
-            method, args = json.loads(body)
-            service = self.service_methods[service_url]
-            method = service.methods[method]
+            method_name, args = json.loads(body)
+            method = self._url_method_index[(service_url, method_name)]
             output = method.main(self, args)
             session.update_key()
-            body = session.encrypt(json.dumps(output))
+            body = session.encrypt_into(bytearray(json.dumps(output), "utf-8"))
             serverclient.write_body(
                 200,
                 "application/octet-stream",
@@ -185,20 +192,20 @@ class BaseDevice():
             serverclient.write_body(
                 200,
                 "text/plain; charset=utf-8",
-                algorithm
+                algorithm.encode("utf-8")
             )
             self.sessions[uuid] = SCSession(cert, algorithm)
         except KeyError as ke:
             serverclient.write_body(
                 401,
                 "application/json",
-                json.dumps(dict(missing=ke.message))
+                json.dumps(dict(missing=str(ke.args[0]))).encode("utf-8")
             )
         except NullCertificateError as nce:
             serverclient.write_body(
                 401,
                 "application/json",
-                json.dumps(dict(missing="certificate"))
+                json.dumps(dict(missing="certificate")).encode("utf-8")
             )
         except Exception as e:
             logging.error(e)
@@ -1,14 +1,42 @@
+import os
 import json
+import errno
 import socket
 import logging
-from select import select
-from threading import Thread
+import selectors
+from functools import lru_cache
+from collections import deque
+from threading import Thread, Lock
 
 from .mpsc import Channel
 from ..utils import Instant
 from ..http.httpbase import httputil
 
 SUB_TIMEOUT = 180
+# the amount of time, in seconds, that a host has to respond to a notification
+RESPONSE_TIMEOUT = 5.0
+# how long the dispatcher sleeps when no host owes it a response
+DISPATCH_TIMEOUT = 15.0
+
+# MSG_NOSIGNAL is Linux only; elsewhere Python already ignores SIGPIPE
+_SEND_FLAGS = getattr(socket, "MSG_NOSIGNAL", 0)
+
+_NOTIFY_TEMPLATE = (
+    b"NOTIFY / HTTP/1.1\r\n"
+    b"Host: %s:%d\r\n"
+    b"NT: iotscp:event; event-name=%s\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+    b"%s"
+)
+_POKE_TEMPLATE = (
+    b"NOTIFY / HTTP/1.1\r\n"
+    b"Host: %s:%d\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+)
 
 def should_keep_alive(res):
     if res.code != 200:
@@ -22,83 +50,63 @@ def should_keep_alive(res):
         return False
     return True
 
-def make_notification(sub_addr, event):
-    """make_notification(sub_addr, event_dict) -> http_event_u8
+@lru_cache(maxsize=256)
+def _encode(_str):
+    # hosts and event names repeat for every notification, so only encode
+    # each of them once
+    return _str.encode("utf-8")
+
+def make_notification(sub_addr, event_name, body):
+    """make_notification(sub_addr, event_name_u8, body_u8) -> http_event_u8
 
-    Create a HTTP notification message for the event.
+    Create a HTTP notification message for the event. `body` is the event,
+    already serialized as JSON.
     """
-    str_event = json.dumps(event)
-    return bytearray("\r\n".join((
-        "NOTIFY / HTTP/1.1",
-        "Host: %s:%s" % sub_addr,
-        "NT: iotscp:event; event-name=%s" % event["name"],
-        "Content-Type: application/json",
-        "Content-Length: %s" % len(str_event),
-        "Connection: keep-alive",
-        "",
-        str_event
-    )), "utf-8")
-
-def poke(sub_addr, sub_sock):
-    """poke(sub_addr, sub_sock) -> keep_alive_bool
+    return _NOTIFY_TEMPLATE % (
+        _encode(sub_addr[0]),
+        sub_addr[1],
+        event_name,
+        len(body),
+        body
+    )
+
+def make_poke(sub_addr):
+    """make_poke(sub_addr) -> http_poke_u8
 
     Create a HTTP notification to keep this connection alive by 'poking' the
     host
     """
-    keep_alive_msg = bytearray("\r\n".join((
-        "NOTIFY / HTTP/1.1",
-        "Host: %s:%s" % sub_addr,
-        "Connection: keep-alive",
-        "",
-        ""
-    )), "ascii")
-    try:
-        logging.debug("Sending keep-alive message")
-
-        _, wlist, _ = select([], [sub_sock], [], 5.0)
-        if sub_sock not in wlist:
-            logging.error("Connection timed out")
-            return False
-        sub_sock.send(keep_alive_msg)
-        # give the server 5 seconds to respond
-        rlist, _, _ = select([sub_sock], [], [], 5.0)
-        if sub_sock not in rlist:
-            logging.error("Connection timed out")
-            return False
-        res = httputil.HttpResponse(sub_sock)
-        return should_keep_alive(res)
-    except Exception as e:
-        logging.error("%s:%s->%s" % (sub_addr[0], sub_addr[1], e))
-        return False
-
+    return _POKE_TEMPLATE % (_encode(sub_addr[0]), sub_addr[1])
 
-def send_event_http(event, sub_addr, sub_sock):
-    """send_event_http(event_dict, sub_addr, sub_sock) -> keep_alive_bool
+class _Connection():
+    """_Connection(sub_addr, sub_sock) -> _Connection
 
-    Sends a notification and determines if the connection should be kept alive.
+    The dispatcher's view of a single host: its socket, the notifications
+    waiting to be written to it, and how long it has been quiet.
     """
-    try:
-        logging.debug("Sending notification")
+    def __init__(self, sub_addr, sub_sock):
+        self.sub_addr = sub_addr
+        self.sock = sub_sock
+        self.pending = deque()
+        # the part of the host's response recvd so far
+        self.buf = bytearray()
+        # set while the non-blocking connect to the host is in progress
+        self.connecting = Instant()
+        # set while waiting for the host to respond to a notification
+        self.sent = None
+        self.idle = Instant()
 
-        req = make_notification(sub_addr, event)
-        _, wlist, _ = select([], [sub_sock], [], 5.0)
-        if sub_sock not in wlist:
-            logging.error("Connection timed out")
-            return False
-        sub_sock.send(req)
-        # give the server 5 seconds to respond
-        rlist, _, _ = select([sub_sock], [], [], 5.0)
-        if sub_sock not in rlist:
-            logging.error("Connection timed out")
-            return False
-        res = httputil.HttpResponse(sub_sock)
-        return should_keep_alive(res)
-    except Exception as e:
-        logging.error("%s:%s->%s" % (sub_addr[0], sub_addr[1], e))
-        return False
+    def events(self):
+        """Returns the selector events this connection is waiting on"""
+        if self.connecting is not None:
+            # the socket becomes writable once the connect has finished
+            return selectors.EVENT_WRITE
+        if self.pending and self.sent is None:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
 
 class EventDispatcher():
-    """EventDispatcher(stop_event) -> EventDispatcher
+    """EventDispatcher(stop_StopFlag) -> EventDispatcher
 
     This class forms a pyramid/funnel:
           Host
@@ -107,85 +115,286 @@ class EventDispatcher():
     where each host has one connection to this device. All notifications that
     the host is subscribed to are sent over that single connection. When dealing
     with multiple hosts, this will form a star network with the device in the
-    middle.
+    middle. Every connection is serviced by a single dispatcher thread that is
+    started the first time an event is sent.
     """
-    def __init__(self, stop_event):
-        self.stop_event = stop_event
+    def __init__(self, stop):
+        self.stop = stop
         self.subscribers = {}
-        self.event_loops = {}
+        self.connections = {}
+        self.channel = Channel()
+        self._selector = selectors.DefaultSelector()
+        # written to by send_event so the dispatcher thread wakes up from
+        # select() as soon as there is something to send
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = None
+        self._thread_lock = Lock()
+        # subscribers are added by the server's thread and removed by the
+        # dispatcher's
+        self._subscribers_lock = Lock()
 
     def add_subscriber(self, event_url, sub_addr):
         """add_subscriber(event_url_str, sub_addr)
 
         Add a subscriber to this event dispatcher
         """
-        if event_url in self.subscribers:
-            if sub_addr not in self.subscribers[event_url]:
-                self.subscribers[event_url].append(sub_addr)
-        # the chance of an unsupported subscription is handled by the device
+        # subscribers are kept as dict keys (values are unused) for O(1)
+        # membership checks and removal while preserving subscription order
+        with self._subscribers_lock:
+            if event_url in self.subscribers:
+                self.subscribers[event_url][sub_addr] = None
+            # the chance of an unsupported subscription is handled by the
+            # device
+            else:
+                self.subscribers[event_url] = {sub_addr: None}
+
+    def _remove_subscriber(self, sub_addr):
+        with self._subscribers_lock:
+            for subs in self.subscribers.values():
+                subs.pop(sub_addr, None)
+            logging.debug(self.subscribers)
+
+    def _update(self, conn):
+        self._selector.modify(conn.sock, conn.events(), conn)
+
+    def _flush(self, conn):
+        """_flush(conn)
+
+        Write to the host straight away if it is not waiting on a response.
+        The selector only watches for writability when the socket's send buffer
+        is full, which saves a trip through select() for every notification.
+        """
+        if conn.pending and conn.sent is None and conn.connecting is None:
+            self._write_pending(conn)
         else:
-            self.subscribers[event_url] = [sub_addr]
+            self._update(conn)
 
-    def _event_loop(self, rx, sub_addr, sub_sock):
-        """_event_loop(rx_channel, sub_addr, sub_sock)
+    def _close(self, conn, unsubscribe=False):
+        """_close(conn, [unsubscribe_bool])
 
-        Loop while the connection remains open, wait for input from the channel.
+        Close the connection with the host. The host stays subscribed, and is
+        connected to again for its next event, unless `unsubscribe` is True.
         """
-        keep_alive = True
-        timeout = Instant()
-        while keep_alive and not self.stop_event.is_set():
-            for event in rx.get_iter(15.0):
-                keep_alive = send_event_http(event, sub_addr, sub_sock)
-                timeout.reset()
-            if timeout.elapsed() >= SUB_TIMEOUT:
-                # try to keep the connection alive
-                if poke(sub_addr, sub_sock):
-                    timeout.reset()
-                else:
-                    break
-        # close this channel
         logging.debug("Closing connection")
-        del self.event_loops[sub_addr]
-        for subs in self.subscribers.values():
-            if sub_addr in subs:
-                subs.remove(sub_addr)
-        logging.debug(self.subscribers)
-
-    def _send_event(self, sub_addr, event):
-        """_send_event(sub_addr, event_dict)
-
-        Check for connection with host: if one does not exist, create one. Upon
-        connection creation, check for keep_alive support. If supported, begin a
-        new event loop with a multi-producer-single-consumer channel and save it
-        for later.
+        self._selector.unregister(conn.sock)
+        conn.sock.close()
+        del self.connections[conn.sub_addr]
+        if unsubscribe:
+            self._remove_subscriber(conn.sub_addr)
+
+    def _send_event(self, sub_addr, event_name, body):
+        """_send_event(sub_addr, event_name_u8, body_u8)
+
+        Check for connection with host: if one does not exist, start one and
+        register it with the selector. The connect finishes in the dispatch
+        loop, so an unreachable host doesn't hold up the others. The
+        notification is queued on the connection and written as soon as the
+        host is ready for it.
         """
-        if sub_addr not in self.event_loops:
-            sub_sock = socket.socket()
-            sub_sock.connect(sub_addr)
+        conn = self.connections.get(sub_addr)
+        if conn is None:
+            if ":" in sub_addr[0]:
+                sub_sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            else:
+                sub_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sub_sock.setblocking(False)
-            keep_alive = send_event_http(event, sub_addr, sub_sock)
-            if keep_alive:
-                tx = rx = Channel()
-                self.event_loops[sub_addr] = tx
-                Thread(
-                    target=self._event_loop,
-                    args=(rx, sub_addr, sub_sock)
-                ).start()
+            try:
+                err = sub_sock.connect_ex(sub_addr)
+            except Exception as e:
+                err = e
+            if err not in (0, errno.EINPROGRESS):
+                if isinstance(err, int):
+                    err = OSError(err, os.strerror(err))
+                logging.error("%s:%s->%s", sub_addr[0], sub_addr[1], err)
+                sub_sock.close()
+                self._remove_subscriber(sub_addr)
+                return
+            # notifications are small and latency sensitive, don't let Nagle's
+            # algorithm hold them back
+            sub_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sub_addr, sub_sock)
+            self.connections[sub_addr] = conn
+            self._selector.register(sub_sock, conn.events(), conn)
+        logging.debug("Sending notification")
+        conn.pending.append(make_notification(sub_addr, event_name, body))
+        self._flush(conn)
+
+    def _finish_connect(self, conn):
+        """_finish_connect(conn)
+
+        Called once the socket is writable after a non-blocking connect.
+        Closes the connection if the connect failed.
+        """
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            logging.error(
+                "%s:%s->%s", conn.sub_addr[0], conn.sub_addr[1],
+                OSError(err, os.strerror(err))
+            )
+            self._close(conn, unsubscribe=True)
+            return
+        conn.connecting = None
+        conn.idle.reset()
+        self._flush(conn)
+
+    def _write_pending(self, conn):
+        """_write_pending(conn)
+
+        Write the next queued notification to the host
+        """
+        msg = conn.pending.popleft()
+        try:
+            sent = conn.sock.send(msg, _SEND_FLAGS)
+        except BlockingIOError:
+            sent = 0
+        except Exception as e:
+            logging.error("%s:%s->%s", conn.sub_addr[0], conn.sub_addr[1], e)
+            self._close(conn)
+            return
+        if sent < len(msg):
+            conn.pending.appendleft(msg[sent:])
+        else:
+            conn.sent = Instant()
+        self._update(conn)
+
+    def _read_response(self, conn):
+        """_read_response(conn)
+
+        Read what the host has sent of its response. Once all of it has been
+        recvd, determine if the connection should be kept alive.
+        """
+        closed = False
+        try:
+            while True:
+                data = conn.sock.recv(httputil.BUFSIZE)
+                if not data:
+                    # the response may still have arrived in full first
+                    closed = True
+                    break
+                conn.buf.extend(data)
+        except BlockingIOError:
+            # everything that has arrived so far has been read
+            pass
+        except Exception as e:
+            logging.error("%s:%s->%s", conn.sub_addr[0], conn.sub_addr[1], e)
+            self._close(conn)
+            return
+        try:
+            length = httputil.get_request_length(conn.buf)
+            if length is None or length > len(conn.buf):
+                if closed:
+                    raise httputil.HTTPError("Host closed the connection")
+                # wait for the rest of the response
+                return
+            reader = httputil.BufferedClient()
+            reader.reset(conn.buf[:length])
+            del conn.buf[:length]
+            keep_alive = should_keep_alive(httputil.HttpResponse(reader))
+        except Exception as e:
+            logging.error("%s:%s->%s", conn.sub_addr[0], conn.sub_addr[1], e)
+            keep_alive = False
+        if keep_alive and not closed:
+            conn.sent = None
+            conn.idle.reset()
+            self._flush(conn)
         else:
-            self.event_loops[sub_addr].send(event)
+            self._close(conn)
+
+    def _check_timeouts(self):
+        """Close connections to unresponsive hosts and poke idle ones"""
+        for conn in list(self.connections.values()):
+            if conn.connecting is not None:
+                # give the host 5 seconds to accept the connection
+                if conn.connecting.elapsed() >= RESPONSE_TIMEOUT:
+                    logging.error("Connection timed out")
+                    self._close(conn, unsubscribe=True)
+            elif conn.sent is not None:
+                # give the host 5 seconds to respond
+                if conn.sent.elapsed() >= RESPONSE_TIMEOUT:
+                    logging.error("Connection timed out")
+                    self._close(conn)
+            elif not conn.pending and conn.idle.elapsed() >= SUB_TIMEOUT:
+                # try to keep the connection alive
+                logging.debug("Sending keep-alive message")
+                conn.pending.append(make_poke(conn.sub_addr))
+                self._flush(conn)
+
+    def _dispatch_loop(self):
+        """_dispatch_loop()
+
+        Loop until the stop flag is set, multiplexing every host connection
+        on this one thread: queued events are written as sockets become
+        writable, and responses are read as they arrive.
+        """
+        while not self.stop.stopped:
+            try:
+                self._dispatch_once()
+            except Exception as e:
+                # one bad host or event must not stop delivery to the others
+                logging.error("Event dispatcher: %s", e)
+        for conn in self.connections.values():
+            conn.sock.close()
+        self.connections.clear()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        logging.debug("Event dispatcher offline")
+
+    def _dispatch_once(self):
+        timeout = DISPATCH_TIMEOUT
+        for conn in self.connections.values():
+            # wake up often enough to notice unresponsive hosts
+            if conn.sent is not None or conn.connecting is not None:
+                timeout = 1.0
+                break
+        for key, mask in self._selector.select(timeout):
+            if key.fileobj is self._wake_r:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            elif self.connections.get(key.data.sub_addr) is not key.data:
+                # closed while handling an earlier event in this batch
+                continue
+            elif key.data.connecting is not None:
+                self._finish_connect(key.data)
+            elif mask & selectors.EVENT_READ:
+                self._read_response(key.data)
+            else:
+                self._write_pending(key.data)
+        for sub_addr, event_name, body in self.channel.get_iter(0):
+            self._send_event(sub_addr, event_name, body)
+        self._check_timeouts()
 
     def send_event(self, event_url, event):
         """send_event(event_url_str, event_dict)
 
         Sends the event to all hosts that are subscribed to the service
         """
-        subscribers = self.subscribers[event_url]
-        i = 0
-        while i < len(subscribers):
-            try:
-                sub_addr = subscribers[i]
-                self._send_event(sub_addr, event)
-                i += 1
-            except Exception as e:
-                logging.error(e)
-                del subscribers[i]
+        if self.stop.stopped:
+            # nothing would deliver it
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._dispatch_loop, args=())
+                self._thread.name = "Event dispatcher thread"
+                self._thread.start()
+        # serialize the event once, rather than once per subscriber
+        event_name = _encode(event["name"])
+        body = json.dumps(event).encode("utf-8")
+        with self._subscribers_lock:
+            subscribers = list(self.subscribers[event_url])
+        for sub_addr in subscribers:
+            self.channel.send((sub_addr, event_name, body))
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # the dispatcher already has a wake up pending
+            pass
+        except OSError:
+            # the dispatcher stopped while this event was being queued
+            pass
@@ -1,23 +1,20 @@
-from threading import Condition
-from collections import deque
-from time import sleep
+from queue import SimpleQueue, Empty
 
 class Channel():
     """This class is a multi-producer, single-consumer FIFO queue, providing
-    message-based blocking communcations over channels 
+    message-based blocking communcations over channels
     """
     def __init__(self):
-        self.cond = Condition()
-        self.queue = deque([])
+        # SimpleQueue is implemented in C and does not need a Condition to
+        # wake the consumer
+        self.queue = SimpleQueue()
 
     def has_data(self):
-        return len(self.queue) > 0
+        return not self.queue.empty()
 
     def send(self, obj):
         """Used by the sending half of the channel to send information"""
-        with self.cond:
-            self.queue.append(obj)
-            self.cond.notify_all()
+        self.queue.put(obj)
 
     def recv(self, timeout=None):
         """recv(timeout_float) -> msg_obj
@@ -25,22 +22,25 @@ class Channel():
         Waits `timeout` seconds for a message. Returns None if timeout occurs
         otherwise returns the first object in the channel's buffer
         """
-        with self.cond:
-            if not self.has_data():
-                self.cond.wait(timeout)
-        if self.has_data():
-            return self.queue.popleft()
-        else:
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
             return None
 
     def get_iter(self, timeout=None):
         """get_iter(timeout_float) -> msg_obj_iter
 
         Waits `timeout` seconds for a message. Returns None if timeout occurs
-        otherwise returns an iterator over all objects in the channel's buffer
+        otherwise returns an iterator over all objects that were in the
+        channel's buffer when the wait ended
         """
-        with self.cond:
-            if not self.has_data():
-                self.cond.wait(timeout)
-        while self.has_data():
-            yield self.queue.popleft()
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return
+        # drain the buffer in one pass, so that producers which keep sending
+        # can't hold the consumer here indefinitely
+        get = self.queue.get_nowait
+        for _ in range(self.queue.qsize()):
+            batch.append(get())
+        yield from batch
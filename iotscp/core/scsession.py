@@ -1,10 +1,16 @@
 from time import time
 from math import ceil
+from functools import lru_cache
 from datetime import timedelta
-from hashlib import pbkdf2_hmac
+import hmac
 
 import logging
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from ..utils import Instant, get_algorithms
 
 ALGORITHMS = get_algorithms()
@@ -19,6 +25,30 @@ def get_common_algorithm(external, prefered=None):
     """Get either this device's prefered algorithm, or the best one shared
     between the device and the other host.
     """
+    # hosts tend to offer the same algorithms every time they connect
+    return _get_common_algorithm(frozenset(external), prefered)
+
+def hkdf(hashtype, key, salt, info, length):
+    """hkdf(hashtype_str, key_u8, salt_u8, info_u8, length_int) -> key_u8
+
+    HKDF (RFC 5869). When salt is None, `key` is assumed to already be a
+    pseudorandom key and only the expand step is done.
+    """
+    if salt is not None:
+        key = hmac.new(salt, key, hashtype).digest()
+    okm = bytearray()
+    block = b""
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(
+            key, block + info + bytes((counter,)), hashtype
+        ).digest()
+        okm.extend(block)
+        counter += 1
+    return okm[:length]
+
+@lru_cache(maxsize=64)
+def _get_common_algorithm(external, prefered):
     if prefered is not None:
         if prefered in external:
             return prefered
@@ -37,37 +67,49 @@ class SCSession():
     def __init__(self, cert, hashtype):
         self.cert = cert
         self.__hashtype = hashtype
-        self.cipher = bytearray(range(256))
+        # the cipher lives in the first half of the table and its inverse in
+        # the second, so that both can be kept up to date in one pass
+        self.__lut = bytearray(range(256)) * 2
+        view = memoryview(self.__lut)
+        self.cipher = view[:256]
+        self.__inv_cipher = view[256:]
+        if np is not None:
+            # views of the table, so that encrypt/decrypt can do the whole
+            # message in a few vector ops
+            lut = np.frombuffer(self.__lut, dtype=np.uint8)
+            self.__np_cipher = lut[:256]
+            self.__np_inv = lut[256:]
         self.__prev_key = self.__fresh_key()
         self.__start = Instant()
         self.__new_key = self.__derived_key()
+        # set by update_key; the cipher is randomized by the next
+        # encrypt/decrypt, which keeps this cheap to check on every call
+        self.__key_used = False
 
     def __get_next_segment_time(self):
-        t = self.__start.elapsed()
-        logging.debug("Elapsed: %d" % int(clamp_to(ceil(t), KEY_TTL)))
-        return int(clamp_to(ceil(t), KEY_TTL))
+        segment = int(clamp_to(ceil(self.__start.elapsed()), KEY_TTL))
+        logging.debug("Elapsed: %d", segment)
+        return segment
 
+    # certificate segments are random bytes rather than passwords, so there is
+    # nothing for a slow key derivation function (like PBKDF2) to protect
     def __fresh_key(self):
-        return bytearray(
-            pbkdf2_hmac(
-                self.__hashtype,
-                self.cert.get_key_segment(),
-                str(clamp_to(ceil(time()), KEY_TTL)),
-                10000,
-                256
-            )
+        return hkdf(
+            self.__hashtype,
+            self.cert.get_key_segment(),
+            str(clamp_to(ceil(time()), KEY_TTL)).encode("ascii"),
+            b"",
+            256
         )
 
     # generate a new key from the old one and how long the session has been alive
     def __derived_key(self):
-        return bytearray(
-            pbkdf2_hmac(
-                self.__hashtype,
-                self.__prev_key,
-                str(self.__get_next_segment_time()),
-                100,
-                256
-            )
+        return hkdf(
+            self.__hashtype,
+            bytes(self.__prev_key),
+            None,
+            str(self.__get_next_segment_time()).encode("ascii"),
+            256
         )
 
     def __get_key(self):
@@ -77,34 +119,57 @@ class SCSession():
 
     def __randomize(self):
         key = self.__get_key()
-        cipher = self.cipher
-        i = 0
-        while i < 256:
-            old = cipher[i]
-            cipher[i] = cipher[key[i]]
-            cipher[key[i]] = old
-            i += 1
+        self.__key_used = False
+        lut = self.__lut
+        # every swap depends on the ones before it, so this has to stay a
+        # sequential walk over the key
+        for i, k in enumerate(key):
+            a, b = lut[i], lut[k]
+            lut[i], lut[k] = b, a
+            lut[256 + b] = i
+            lut[256 + a] = k
+
+    def __keystream(self, n):
+        # the keystream is the cipher repeated over the length of the message
+        return (self.__lut[:256] * (n // 256 + 1))[:n]
 
     def get_hashtype(self):
         """returns the best hash type that both server and device supported"""
         return self.__hashtype
 
     def encrypt(self, input_u8):
-        """Encrypt a bytearray or str using this session's key generator
+        """Encrypt bytes or a str using this session's key generator
+
+        The input is left untouched; see encrypt_into for encrypting a
+        bytearray in place.
+
+        returns a new bytearray
+        """
+        if isinstance(input_u8, str):
+            return self.encrypt_into(bytearray(input_u8, "utf-8"))
+        return self.encrypt_into(bytearray(input_u8))
+
+    def encrypt_into(self, input_u8):
+        """Encrypt a bytearray in place using this session's key generator
 
         Encryption is based on a direct translation to the class's internally
         kept block cipher, followed by a XOR between input[n] and cipher[n]
 
-        returns a bytearray
+        returns input_u8
         """
-        if self.__prev_key == self.__new_key:
+        if self.__key_used:
             self.__randomize()
-        if not isinstance(input_u8, bytearray):
-            input_u8 = bytearray(input_u8, "utf-8")
-        i = 0
-        while i < len(input_u8):
-            input_u8[i] = self.cipher[input_u8[i]] ^ self.cipher[i%256]
-            i += 1
+        if np is not None:
+            arr = np.frombuffer(input_u8, dtype=np.uint8)
+            cipher = self.__np_cipher
+            np.bitwise_xor(cipher[arr], np.resize(cipher, arr.size), out=arr)
+            return input_u8
+        # without NumPy, translate and int XOR still do the per-byte work in C
+        n = len(input_u8)
+        input_u8[:] = (
+            int.from_bytes(input_u8.translate(self.cipher), "little")
+            ^ int.from_bytes(self.__keystream(n), "little")
+        ).to_bytes(n, "little")
         return input_u8
 
     def decrypt(self, input_u8):
@@ -115,13 +180,18 @@ class SCSession():
 
         returns a utf-8 str
         """
-        if self.__prev_key == self.__new_key:
+        if self.__key_used:
             self.__randomize()
-        key_map = {b:i for i, b in enumerate(self.cipher)}
-        i = 0
-        while i < len(input_u8):
-            input_u8[i] = key_map[input_u8[i] ^ self.cipher[i%256]]
-            i += 1
+        if np is not None:
+            arr = np.frombuffer(input_u8, dtype=np.uint8)
+            arr ^= np.resize(self.__np_cipher, arr.size)
+            arr[:] = self.__np_inv[arr]
+            return input_u8.decode("utf-8")
+        n = len(input_u8)
+        input_u8[:] = (
+            int.from_bytes(input_u8, "little")
+            ^ int.from_bytes(self.__keystream(n), "little")
+        ).to_bytes(n, "little").translate(self.__inv_cipher)
         return input_u8.decode("utf-8")
 
     # in the future it may be a good idea to integrate this into a
@@ -133,3 +203,4 @@ class SCSession():
         is used
         """
         self.__prev_key = self.__new_key
+        self.__key_used = True
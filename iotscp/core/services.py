@@ -11,33 +11,38 @@ class ServiceArgError(Exception):
     def __str__(self):
         return repr(self.value)
 
-class ServiceArg(tuple):
+# define concrete types
+# the strings represent types that all devices should support
+_TYPE_NAMES = {
+    bool: "bool",
+    dict: "map",
+    float: "float",
+    int: "int",
+    list: "list",
+    str: "string",
+}
+
+class ServiceArg():
     """ServiceArg(name_str, type_str) -> ServiceArg
 
     This class is used to define what types a service method can accept or
-    return, and what types a service event can send
+    return, and what types a service event can send. It unpacks like a
+    (name, type) pair.
     """
-    # define concrete types
-    # the strings represent types that all devices should support
-    __type_map = {
-        bool: "bool",
-        dict: "map",
-        float: "float",
-        int: "int",
-        list: "list",
-        str: "string",
-    }
+    __slots__ = ("name", "type")
+
     def __init__(self, name, type):
-        if type not in self.__type_map:
+        if type not in _TYPE_NAMES:
             raise ServiceArgError("Type %s is not supported" % type)
         self.name = name
         self.type = type
 
-    def __new__(cls, name, type):
-        return tuple.__new__(cls, (name, type))
+    def __iter__(self):
+        yield self.name
+        yield self.type
 
     def __str__(self):
-        return "%s: %s" % (self.name, self.__type_map[self.type])
+        return "%s: %s" % (self.name, _TYPE_NAMES[self.type])
 
     def __repr__(self):
         return "ServiceArg(name=%s, type=%s)" % (self.name, self.type)
@@ -83,6 +88,9 @@ class ServiceMethod():
         self.thunk = thunk
         self.args = args
         self.returns = returns
+        # (name, type) pairs, so that calls don't have to unpack ServiceArgs
+        self.__arg_types = tuple((arg.name, arg.type) for arg in args)
+        self.__return_types = tuple((ret.name, ret.type) for ret in returns)
         self.__doc__ = doc
 
     def verify_output(self, output):
@@ -97,8 +105,7 @@ class ServiceMethod():
         Raises ServiceMethodError if the output is incorrect
         """
         if output is not None:
-            for svcarg in self.returns:
-                arg, _type = svcarg
+            for arg, _type in self.__return_types:
                 if arg not in output:
                     raise ServiceMethodError(
                         "Missing return value: %s" % arg
@@ -115,13 +122,13 @@ class ServiceMethod():
 
     def main(self, device, args_dict):
         """Calls the service method's thunk"""
-        for arg, _type in self.args:
+        for arg, _type in self.__arg_types:
             if arg not in args_dict:
                 raise ServiceArgError("Missing arguments: %s" % arg)
-            elif not isinstance(arg, _type):
+            elif not isinstance(args_dict[arg], _type):
                 raise ServiceArgError(
                     "Type mismatch error at `%s`: expected %s, got %s"
-                    % (arg, _type, type(arg))
+                    % (arg, _type, type(args_dict[arg]))
                 )
         output = self.thunk(device, **args_dict)
         if self.returns is not None:
@@ -156,6 +163,7 @@ class ServiceEvent():
         if isinstance(sends, ServiceArg):
             sends = [sends]
         self.sends = {arg.name: arg for arg in sends}
+        self.__types = {arg.name: arg.type for arg in sends}
         self.__doc__ = doc
 
     def validate(self, kwargs):
@@ -164,16 +172,16 @@ class ServiceEvent():
         This is used externally by the Service class to ensure that sent events
         match their definition
         """
+        types = self.__types
         for k, arg in kwargs.items():
-            if not k in self.sends:
+            _type = types.get(k)
+            if _type is None:
                 raise ServiceArgError("Invalid event argument `%s`" % k)
-            else:
-                _type = self.sends[k].type
-                if not isinstance(arg, _type):
-                    raise ServiceArgError(
-                        "Type mismatch error at `%s`: expected %s, got %s"
-                        % (k, _type, type(arg))
-                    )
+            elif not isinstance(arg, _type):
+                raise ServiceArgError(
+                    "Type mismatch error at `%s`: expected %s, got %s"
+                    % (k, _type, type(arg))
+                )
 
     def values_dict(self):
         """Returns a dict of ServiceEvent-defining data"""
@@ -240,14 +248,23 @@ class Service():
             elif field == "name":
                 verify_str(field_value, field)
             elif field == "methods" or field == "events":
-                setattr(self, field, {obj.name: obj for obj in field_value})
-            self.spec_url = "%s.json" % self.name.lower()
+                # a dict is assumed to already be keyed by name
+                if not isinstance(field_value, dict):
+                    setattr(
+                        self, field, {obj.name: obj for obj in field_value}
+                    )
+        self.spec_url = "%s.json" % self.name.lower()
         self.dispatcher = None
+        # the spec can't change once the service is built, so it is only
+        # serialized once
+        self.spec_json = json.dumps(
+            self.values_dict(), separators=(",", ":")
+        ).encode("utf-8")
 
     def add_dispatcher(self, dispatcher):
         """Add a reference to the event dispatcher to this service.
         This should only be called by the device itself with a reference to the
-        shutdown event because the dispatcher must know when the server is
+        shutdown flag because the dispatcher must know when the server is
         shutting down.
         """
         # For Rust, this will be a RWLock or a Mutex wrapped in Arc<>
@@ -1,15 +1,48 @@
 import socket
 import logging
 import json
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 
 from .utils import Instant
 from .scdevice import SCDevice
-from .http.httpbase.httputil import parse_headers, HttpResponse
+from .http.httpbase.httputil import (
+    parse_headers, decode_http_head, HttpResponse
+)
 
-try:
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import urlparse
+MCAST_ADDR = ("239.255.255.250", 1900)
+
+_SEARCH_TEMPLATE = (
+    b"IOT-SEARCH * HTTP/1.1\r\n"
+    b"Host: 239.255.255.250:1900\r\n"
+    b"Return: %s\r\n"
+    b"SV: iotscp:discover\r\n"
+    b"\r\n"
+)
+
+_GET_TEMPLATE = (
+    "GET %s HTTP/1.1\r\n"
+    "Host: %s\r\n"
+    "Accept: application/json\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+)
+
+@lru_cache(maxsize=8)
+def make_search(return_type):
+    """make_search(return_type_str) -> search_u8
+
+    Create the IOT-SEARCH datagram for `return_type`. There are only ever a
+    few return types, so each datagram is only built once.
+    """
+    return _SEARCH_TEMPLATE % return_type.encode("ascii")
+
+def _close_unused(future):
+    # done callback for the devices find_devices didn't return
+    device = future.result()
+    if device is not None:
+        device.close()
 
 class SCFinder:
     """SCFinder(cert_SCCertificate) -> SCFinder
@@ -25,22 +58,15 @@ class SCFinder:
         Creates a SCDevice given `location` as a str.
         `location` should take the form http://{ip}:{port}/setup.json
         """
-        purl = urlparse(location)
+        purl = urlsplit(location)
         addr = (purl.hostname, purl.port)
-        sock = socket.socket()
-        msg = bytearray("\r\n".join((
-            "GET {p.path} HTTP/1.1",
-            "Host: {p.netloc}",
-            "Accept: application/json",
-            "Connection: close",
-            "",
-            ""
-        )).format(p=purl), "ascii")
+        msg = (_GET_TEMPLATE % (purl.path, purl.netloc)).encode("ascii")
         try:
-            sock.settimeout(1.0)
-            sock.connect(addr)
-            sock.sendall(msg)
-            res = HttpResponse(sock)
+            with socket.socket() as sock:
+                sock.settimeout(1.0)
+                sock.connect(addr)
+                sock.sendall(msg)
+                res = HttpResponse(sock)
             if res.code == 200:
                 dev_json = json.loads(res.body.decode("utf-8"))
                 return SCDevice(addr, dev_json, self.cert)
@@ -48,44 +74,74 @@ class SCFinder:
             logging.error(e)
         return None
 
-    def find_devices(self, return_type="device; type=basedevice"):
-        """find_devices([return_type_str]) -> devices_list[SCDevice]
+    def find_devices(self, return_type="device; type=basedevice",
+                     max_devices=None):
+        """find_devices([return_type_str, max_devices_int])
+            -> devices_list[SCDevice]
 
         Searchs the multicast group for devices.
         return_type is the type of device you are searching for. There is
         currently only one supported return_type(device; type=basedevice),
         but in the future, additional query options will be available.
+        When max_devices is given, the search ends as soon as that many
+        devices have been found.
         """
-        locations = []
+        seen_locations = set()
+        futures = []
         devices = []
+        # devices are fetched in parallel, so one slow device can't hold up
+        # the rest of the search
+        pool = ThreadPoolExecutor(max_workers=16)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        mcast_addr = ("239.255.255.250", 1900)
-        msg = bytearray("\r\n".join((
-            "IOT-SEARCH * HTTP/1.1",
-            "Host: 239.255.255.250:1900",
-            "Return: %s" % return_type,
-            "SV: iotscp:discover",
-            "", ""
-        )), "ascii")
         timeout = Instant()
         try:
-            sock.sendto(msg, mcast_addr)
-            sock.settimeout(5.0)
+            sock.sendto(make_search(return_type), MCAST_ADDR)
             while timeout.elapsed() < 5.0:
+                # let the socket wait out whatever is left of the search
+                remaining = max(0.05, 5.0 - timeout.elapsed())
+                if max_devices is not None and futures:
+                    # wake up to check on the devices being fetched
+                    remaining = min(remaining, 0.1)
+                sock.settimeout(remaining)
                 try:
                     res, address = sock.recvfrom(400)
-                    headers = parse_headers(res)
+                    headers = parse_headers(decode_http_head(res))
                     location = headers["location"] # http://ip:port/setup.json
-                    if location not in locations:
-                        locations.append(location)
-                        device = self.make_device(location)
-                        if device is not None:
-                            devices.append(device)
-                            logging.debug("Device found!")
+                    if location not in seen_locations:
+                        seen_locations.add(location)
+                        futures.append(
+                            pool.submit(self.make_device, location)
+                        )
                 except socket.timeout:
                     pass
                 except Exception as e:
                     logging.error(repr(e))
+                if max_devices is not None:
+                    found = sum(
+                        1 for f in futures
+                        if f.done() and f.result() is not None
+                    )
+                    if found >= max_devices:
+                        break
         except Exception as e:
             logging.error(e)
+        finally:
+            sock.close()
+        collected = set()
+        try:
+            for future in as_completed(futures):
+                collected.add(future)
+                device = future.result()
+                if device is not None:
+                    devices.append(device)
+                    logging.debug("Device found!")
+                    if len(devices) == max_devices:
+                        break
+        finally:
+            # devices past max_devices are not needed; don't start fetching
+            # them, and close the connections of the ones already underway
+            for future in futures:
+                if future not in collected and not future.cancel():
+                    future.add_done_callback(_close_unused)
+            pool.shutdown(wait=False)
         return devices
@@ -1,34 +1,50 @@
 import os
 import logging
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 from . import WEB_PATH
 from .httpbase.httpserver import HttpServer
 
 _HELLO_URL = "/iotscp/hello"
 
+@lru_cache(maxsize=256)
 def get_os_path(url):
     """get_os_path(url_str) -> os_path_str
 
     Converts the request url to an absolute OS path to a file on the local
-    filesystem
+    filesystem. Devices serve the same few pages over and over, so results are
+    cached.
     """
-    parts = url.split("/")
-    if '?' in parts[-1]:
-        parts[-1] = parts[-1].split('?')[0]
-    elif '#' in parts[-1]:
-        parts[-1] = parts[-1].split('#')[0]
-    if '.' not in parts[-1]:
-        parts.append("index.html")
-    return os.path.join(WEB_PATH, *parts)
+    path = urlsplit(url).path
+    if not os.path.splitext(path)[1]:
+        path = path.rstrip("/") + "/index.html"
+    return os.path.join(WEB_PATH, *path.split("/"))
+
+@lru_cache(maxsize=256)
+def file_exists(path):
+    """file_exists(os_path_str) -> exists_bool
+
+    os.path.exists, cached until the server shuts down
+    """
+    return os.path.exists(path)
 
 class DeviceServer(HttpServer):
-    """DeviceServer(stop_event, port_int, device_BaseDevice) -> DeviceServer
+    """DeviceServer(stop_StopFlag, port_int, device_BaseDevice) -> DeviceServer
 
     Handles http requests made to the device.
     """
+    # POSTs run the device's service methods, which may take a while, so they
+    # are handled by workers rather than on the listening thread
+    threaded_handles = frozenset(("POST",))
+
     def __init__(self, stop, port, device):
         HttpServer.__init__(self, stop, port)
         self.device = device
+        # service specs are served from memory rather than from their files
+        self.specs = {
+            "/" + svc.spec_url: svc.spec_json for svc in device.services
+        }
         self.handles = dict(
             GET=self.GET,
             POST=self.POST,
@@ -45,9 +61,13 @@ class DeviceServer(HttpServer):
         Writes --
             404 in cases where the file is not found
         """
+        spec = self.specs.get(serverclient.req.url)
+        if spec is not None:
+            serverclient.write_body(200, "application/json", spec)
+            return
         path = get_os_path(serverclient.req.url)
         logging.debug(path)
-        if os.path.exists(path):
+        if file_exists(path):
             serverclient.write_file(path)
         else:
             logging.debug("404 Not Found")
@@ -90,3 +110,8 @@ class DeviceServer(HttpServer):
             self.device.add_subscriber(uuid, serverclient)
         else:
             serverclient.write_head(401)
+
+    def shutdown(self):
+        # pages may change before the server is started again
+        get_os_path.cache_clear()
+        file_exists.cache_clear()
@@ -1,16 +1,27 @@
-import errno
+import heapq
 import socket
 import logging
-from select import select
-from threading import Thread, Event
+import selectors
+from queue import SimpleQueue
+from itertools import islice
+from collections import deque
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 from . import httputil, LISTEN_TIMEOUT
 from ...utils import Instant
-from .serverclient import ServerClient
+from .serverclient import ServerClient, FileBody
+
+# Linux only; tells the kernel that a file follows the buffers being sent
+_MSG_MORE = getattr(socket, "MSG_MORE", 0)
 
 # Client can live for 5 minutes * 60 seconds = 300 seconds before
 # the connection should be closed forcibly
 CLIENT_TIMEOUT = 300
+# A client that takes none of its responses for this many seconds is closed
+WRITE_TIMEOUT = 5.0
+# The number of threads that run the handles in HttpServer.threaded_handles
+HANDLE_THREADS = 8
 
 class NoHandleError(Exception):
     def __init__(self, req_type):
@@ -19,14 +30,97 @@ class NoHandleError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class _ConnectionState():
+    """_ConnectionState(client_sock, addr) -> _ConnectionState
+
+    The listening thread's view of a single client: the bytes recvd that have
+    not been handled yet, the responses that have not been sent yet, and when
+    the client last sent or took anything.
+    """
+    def __init__(self, client, addr):
+        self.client = client
+        self.addr = addr
+        self.buf = bytearray()
+        # buffers and FileBodys waiting to be sent, in order
+        self.pending = deque()
+        # set once a response says the connection should not be kept alive;
+        # the connection is closed as soon as `pending` is empty
+        self.close_after = False
+        self.events = selectors.EVENT_READ
+        self.last_active = Instant()
+        # set while one of this client's requests is being handled by a
+        # worker; its other requests wait until the worker is done
+        self.busy = False
+        # the deadline of this connection's entry in the server's expiry heap
+        self.expires_at = None
+        self.closed = False
+        # reused by every request on this connection
+        self.reader = httputil.BufferedClient()
+        self.serverclient = None
+
+    def deadline(self):
+        """Returns the time at which this client should be forcibly closed"""
+        if self.events == selectors.EVENT_WRITE:
+            return self.last_active.start + WRITE_TIMEOUT
+        return self.last_active.start + CLIENT_TIMEOUT
+
+    def write_pending(self):
+        """write_pending() -> drained_bool
+
+        Send as much of the pending output as the client takes without
+        blocking. Runs of buffers are sent with gathered writes (sendmsg).
+        Returns True once everything has been sent
+        """
+        pending = self.pending
+        client = self.client
+        while pending:
+            if isinstance(pending[0], FileBody):
+                body = pending[0]
+                offset = body.offset
+                done = body.send(client)
+                if body.offset != offset:
+                    self.last_active.reset()
+                if not done:
+                    return False
+                pending.popleft()
+                continue
+            bufs = []
+            for buf in islice(pending, httputil.IOV_MAX):
+                if isinstance(buf, FileBody):
+                    break
+                bufs.append(buf)
+            # let a file's head wait for the start of the file
+            flags = _MSG_MORE if len(bufs) < len(pending) else 0
+            try:
+                sent = client.sendmsg(bufs, (), flags)
+            except BlockingIOError:
+                return False
+            self.last_active.reset()
+            httputil.drop_sent(pending, len(bufs), sent)
+        return True
+
+    def discard_pending(self):
+        """Drop everything that has not been sent, closing queued files"""
+        for item in self.pending:
+            if isinstance(item, FileBody):
+                item.close(self.client)
+        self.pending.clear()
+
 class HttpServer:
-    """HttpServer(stop_event, port_int, [address_str]) -> HttpServer
+    """HttpServer(stop_StopFlag, port_int, [address_str]) -> HttpServer
 
     This is a very bare implementation of an HTTP/1.1 server, this class is
     meant to be used as a base class for more specific implementations. It is
     worthless on its own.
+
+    Every client is served by the listening thread, and handles run on it,
+    so a slow handle holds up every client. Handles that may be slow (ones
+    that run user code, for example) should have their req_type listed in
+    `threaded_handles`; those are run by a pool of worker threads instead,
+    and must be safe to call from several threads at once.
     """
     reuse_sock = True
+    threaded_handles = frozenset()
 
     def __init__(self, stop, port, address=""):
         self.address = (address, port)
@@ -39,17 +133,20 @@ class HttpServer:
 
         Raises NoHandleError if there is no handle for req_type
         """
-        if req_type in self.handles:
-            return self.handles[req_type]
-        else:
+        handle = self.handles.get(req_type)
+        if handle is None:
             raise NoHandleError(req_type)
+        return handle
 
-    def handle_one_request(self, client, addr):
-        """handle_one_request(client_sock, addr) -> keep_alive_bool
+    def handle_one_request(self, state, request):
+        """handle_one_request(state, request_u8) -> keep_alive_bool
 
-        Handle one request and return weither or not the connection should be
-        kept alive. At present, this will keep the connection alive unless the
-        client requests it be closed, or their HTTP version is unsupported.
+        Handle one request, already recvd from the client, and return weither
+        or not the connection should be kept alive. At present, this will keep
+        the connection alive unless the client requests it be closed, or their
+        HTTP version is unsupported.
+        If the request's handle is in threaded_handles, it is passed to a
+        worker and None is returned; the connection is busy until it is done.
 
         Writes --
             500 in cases where an unknown error occurs
@@ -57,73 +154,264 @@ class HttpServer:
             505 in cases where the client is using an unsupported HTTP version
         """
         try:
-            req = httputil.HttpRequest(client)
-            serverclient = ServerClient(req, client, addr)
+            state.reader.reset(request)
+            serverclient = state.serverclient
+            if serverclient is None:
+                req = httputil.HttpRequest(state.reader)
+                serverclient = ServerClient(
+                    req, state.client, state.addr, state.pending
+                )
+                state.serverclient = serverclient
+            else:
+                req = serverclient.req
+                req.parse(state.reader)
+                serverclient.reset(req)
             req_type = req.req_type
             handle = self.get_handle(req_type)
-            try:
-                handle(serverclient)
-            except Exception as e:
-                logging.error("Error in handles->%s: %s" % (req_type, e))
-                serverclient.write_generic_body(500)
-                return True
-            logging.debug("keep_alive = %s" % serverclient.keep_alive)
-            return serverclient.keep_alive
-        except httputil.NullRequestError:
-            # This seems to be how most browsers end keep-alive sessions.
-            logging.debug("Null request error")
-            return False
         except httputil.VersionError:
-            serverclient.keep_alive = False
+            if serverclient is None:
+                # the connection's first request; nothing to reuse yet
+                serverclient = ServerClient(
+                    None, state.client, state.addr, state.pending
+                )
+            else:
+                serverclient.reset(None)
             serverclient.write_generic_body(505)
             return False
         except NoHandleError as nhe:
             logging.error(nhe)
             serverclient.write_generic_body(501)
             return True
+        if req_type in self.threaded_handles:
+            state.busy = True
+            self.workers.submit(self._handle_in_worker, state, handle)
+            return None
+        return self.call_handle(handle, serverclient)
 
-    def handlereq(self, client, addr):
-        """handlereq(client_sock, addr)
+    def call_handle(self, handle, serverclient):
+        """call_handle(handle_func, serverclient) -> keep_alive_bool
 
-        Handles requests from the client until either keep_alive is False or
-        CLIENT_TIMEOUT (300 seconds/5 minutes) has passed since the connection
-        was last used.
+        Call `handle` for the request `serverclient` holds, writing 500 if
+        it fails
         """
         try:
-            logging.debug("Connection opened: %s:%s" % addr)
-            # set the socket to non-blocking mode because if everything is done
-            # correctly, blocking should only occur in exceptional situations
-            client.setblocking(False)
-            keep_alive = True
-            timeout = Instant()
-            # essentially another listen loop
-            while (keep_alive and not self.stop.is_set()
-                    and timeout.elapsed() < CLIENT_TIMEOUT):
-                rlist, _, _ = select([client], [], [], LISTEN_TIMEOUT)
-                if client in rlist:
-                    logging.debug("Reading from client")
-                    keep_alive = self.handle_one_request(client, addr)
-                    timeout.reset()
-            if timeout.elapsed() >= CLIENT_TIMEOUT:
-                logging.info("Forcing connection closed...")
-        except socket.error as se:
-            if se.errno == errno.EWOULDBLOCK:
-                logging.error("Connection unexpectedly closed by client")
-            else:
-                logging.error(se)
+            handle(serverclient)
+        except Exception as e:
+            logging.error(
+                "Error in handles->%s: %s", serverclient.req.req_type, e
+            )
+            serverclient.write_generic_body(500)
+            return True
+        logging.debug("keep_alive = %s", serverclient.keep_alive)
+        return serverclient.keep_alive
+
+    def _handle_in_worker(self, state, handle):
+        # runs on a worker; the listening thread leaves `state` alone until
+        # this is posted back to it
+        keep_alive = False
+        try:
+            keep_alive = self.call_handle(handle, state.serverclient)
         except Exception as e:
             logging.error(e)
         finally:
-            client.close()
-            logging.debug("Connection closed")
+            self.done.put((state, keep_alive))
+            try:
+                self._wake_w.send(b"\0")
+            except BlockingIOError:
+                # the listening thread already has a wake up pending
+                pass
+
+    def _finish_handles(self):
+        """Picks up where the listening thread left off with each client whose
+        request a worker has finished handling
+        """
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.done.empty():
+            state, keep_alive = self.done.get()
+            state.busy = False
+            if state.closed:
+                # closed by the server while the worker was running
+                state.discard_pending()
+                continue
+            if not keep_alive:
+                state.close_after = True
+            self._handle_buffered(state)
+
+    def _accept(self):
+        # take every connection that is waiting, not just one per wake up
+        while True:
+            try:
+                client, addr = self.lsock.accept()
+            except BlockingIOError:
+                return
+            logging.debug("Connection opened: %s:%s", *addr)
+            # set the socket to non-blocking mode because if everything is
+            # done correctly, blocking should only occur in exceptional
+            # situations
+            client.setblocking(False)
+            state = _ConnectionState(client, addr)
+            self.sel.register(client, selectors.EVENT_READ, state)
+            self._schedule(state)
+
+    def _close(self, state):
+        state.closed = True
+        self.sel.unregister(state.client)
+        state.discard_pending()
+        state.client.close()
+        logging.debug("Connection closed")
+
+    def handlereq(self, state):
+        """handlereq(state)
+
+        Reads what the client has sent and handles every request that has been
+        completely recvd.
+        """
+        try:
+            logging.debug("Reading from client")
+            data = state.client.recv(httputil.BUFSIZE)
+            if not data:
+                # This seems to be how most browsers end keep-alive sessions.
+                logging.debug("Null request error")
+                self._close(state)
+                return
+            state.buf.extend(data)
+            state.last_active.reset()
+        except BlockingIOError:
+            return
+        except Exception as e:
+            logging.error(e)
+            self._close(state)
+            return
+        if not state.busy:
+            self._handle_buffered(state)
+
+    def _handle_buffered(self, state):
+        """_handle_buffered(state)
+
+        Handles every request from the client that has been completely recvd,
+        then sends their responses together. Stops early at a request that
+        has been passed to a worker.
+        """
+        try:
+            while not state.close_after:
+                length = httputil.get_request_length(state.buf)
+                if length is None or length > len(state.buf):
+                    break
+                request = state.buf[:length]
+                del state.buf[:length]
+                keep_alive = self.handle_one_request(state, request)
+                if keep_alive is None:
+                    # the worker owns the connection's output until it's done
+                    return
+                if not keep_alive:
+                    state.close_after = True
+        except Exception as e:
+            logging.error(e)
+            self._close(state)
+            return
+        self._write(state)
+
+    def _write(self, state):
+        """_write(state)
+
+        Sends what the client will take of its pending responses, without
+        blocking. While anything is left over, the client is only watched for
+        writability, so nothing more is read from a client that isn't reading
+        its responses. The connection is closed once its last response has
+        been sent, if keep_alive was False.
+        """
+        try:
+            drained = state.write_pending()
+        except Exception as e:
+            logging.error("Connection with `%s` failed: %s", state.addr[0], e)
+            self._close(state)
+            return
+        if drained:
+            if state.close_after:
+                self._close(state)
+                return
+            events = selectors.EVENT_READ
+        else:
+            events = selectors.EVENT_WRITE
+        if events != state.events:
+            state.events = events
+            self.sel.modify(state.client, events, state)
+            if events == selectors.EVENT_WRITE:
+                # the write timeout is much shorter than the idle one
+                self._schedule(state)
+
+    def _schedule(self, state):
+        """_schedule(state)
+
+        Make sure the expiry heap wakes up for the client by its deadline.
+        Each client only has one live entry; older ones are skipped.
+        """
+        deadline = state.deadline()
+        if state.expires_at is None or deadline < state.expires_at:
+            state.expires_at = deadline
+            heapq.heappush(self.expiry, (deadline, id(state), state))
+
+    def _expire(self):
+        """Closes the clients that have been idle for CLIENT_TIMEOUT seconds,
+        or that have not taken any of their responses for WRITE_TIMEOUT
+        """
+        expiry = self.expiry
+        now = Instant().start
+        while expiry and expiry[0][0] <= now:
+            expires_at, _, state = heapq.heappop(expiry)
+            if state.closed or expires_at != state.expires_at:
+                # replaced by an earlier entry
+                continue
+            state.expires_at = None
+            if state.deadline() > now:
+                # the client was active since this entry was pushed
+                self._schedule(state)
+            else:
+                logging.info("Forcing connection closed...")
+                self._close(state)
 
     def listen(self):
-        """Accepts connections until `self.stop` is set"""
-        while not self.stop.is_set():
-            self.lsock.listen(5)
-            rlist, _, _ = select([self.lsock], [], [], LISTEN_TIMEOUT)
-            if self.lsock in rlist:
-                Thread(target=self.handlereq, args=self.lsock.accept()).start()
+        """Serves every client from this one thread until `self.stop` is set"""
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.lsock, selectors.EVENT_READ)
+        # workers post (state, keep_alive) to `done`, then wake this thread
+        self.workers = ThreadPoolExecutor(max_workers=HANDLE_THREADS)
+        self.done = SimpleQueue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.sel.register(self._wake_r, selectors.EVENT_READ)
+        # (deadline, id, state) entries; an entry is only acted on once its
+        # deadline has passed, so activity just pushes it back when popped
+        self.expiry = []
+        while not self.stop.stopped:
+            timeout = LISTEN_TIMEOUT
+            if self.expiry:
+                # wake up in time for the next client to expire
+                timeout = max(0, min(
+                    timeout, self.expiry[0][0] - Instant().start
+                ))
+            for key, mask in self.sel.select(timeout):
+                if key.fileobj is self._wake_r:
+                    self._finish_handles()
+                elif key.data is None:
+                    self._accept()
+                elif mask & selectors.EVENT_WRITE:
+                    self._write(key.data)
+                else:
+                    self.handlereq(key.data)
+            self._expire()
+        self.workers.shutdown(wait=True)
+        for key in list(self.sel.get_map().values()):
+            if key.data is not None:
+                self._close(key.data)
+        self.sel.close()
+        self._wake_r.close()
+        self._wake_w.close()
         self._shutdown()
 
     def server_bind(self):
@@ -132,6 +420,8 @@ class HttpServer:
         if self.reuse_sock:
             self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.lsock.bind(self.address)
+        self.lsock.listen(128)
+        self.lsock.setblocking(False)
         self.bound_to = self.lsock.getsockname()
 
     def start(self):
@@ -140,7 +430,7 @@ class HttpServer:
             self.server_bind()
             logging.info(
                 "Starting HTTP server\n"
-                "\t%s:%s" % self.bound_to
+                "\t%s:%s", *self.bound_to
             )
             self.lthread = Thread(target=self.listen, args=())
             self.lthread.name = "Listening thread"
@@ -152,7 +442,7 @@ class HttpServer:
             exit(1)
 
     def _shutdown(self):
-        logging.info("HTTP server %s:%s is now offline" % self.bound_to)
+        logging.info("HTTP server %s:%s is now offline", *self.bound_to)
         self.shutdown()
 
     def shutdown(self):
@@ -1,15 +1,25 @@
+import os
+import sys
 import socket
 import logging
 import re
+from functools import lru_cache
+from itertools import islice
+from collections import deque
+
+try:
+    # llhttp bindings; parses the request head in C when it is available
+    import httptools
+except ImportError:
+    httptools = None
 
 # All the HTTP header types that should be converted to integers
-NUMBER_TYPES = ["content-length"]
+NUMBER_TYPES = frozenset(("content-length",))
 
 # The size of the byte buffers used to recv
 BUFSIZE = 4096
 
 RE_REQLINE = re.compile("(.+?)(?: )(.+?)(?: )(.+?)(?:\r\n)")
-RE_HEADERS = re.compile("(.+?)(?::\s*)(.+?)(?:\r\n)")
 
 class HeaderTypeError(Exception):
     """This error is raised in the event of a type mismatch
@@ -73,71 +83,207 @@ def decode_http_head(head_u8):
     except UnicodeDecodeError:
         raise HTTPError("HTTP head contained invalid characters")
 
-def parse_headers(head_str):
-    """parse_headers(head_str) -> headers_dict
+@lru_cache(maxsize=256)
+def header_key(key):
+    """header_key(key_str) -> key_str
+
+    Lowercases and interns a header name. Requests keep sending the same few
+    headers, so each spelling is only lowered once, and dict lookups with the
+    result compare by identity.
+    """
+    return sys.intern(key.lower())
+
+@lru_cache(maxsize=256)
+def _header_key_u8(key_u8):
+    # header_key for the raw names httptools hands over
+    return header_key(decode_http_head(key_u8))
+
+@lru_cache(maxsize=32)
+def _method_name(method_u8):
+    return sys.intern(decode_http_head(method_u8))
+
+def parse_header_lines(lines):
+    """parse_header_lines(lines_list[str]) -> headers_dict
 
-    Finds all the headers in the HTTP head, converts them to expected types,
-    and places them in a dictionary.
+    Parses `key: value` header lines, converts them to expected types, and
+    places them in a dictionary. Lines without a colon are ignored.
     Returns dictionary containing parsed headers.
     """
     headers_dict = {}
-    for header in RE_HEADERS.finditer(head_str):
-        k, v = header.group(1).lower(), header.group(2)
+    for line in lines:
+        k, sep, v = line.partition(":")
+        if not sep:
+            continue
+        k = header_key(k)
+        v = v.lstrip()
         if k in NUMBER_TYPES:
             v = parse_number(k, v)
         headers_dict[k] = v
     return headers_dict
 
+def parse_headers(head_str):
+    """parse_headers(head_str) -> headers_dict
+
+    Finds all the headers in the HTTP head (everything after the request or
+    status line), converts them to expected types, and places them in a
+    dictionary.
+    Returns dictionary containing parsed headers.
+    """
+    return parse_header_lines(head_str.split("\r\n")[1:])
+
+# The most buffers one gathered write (sendmsg, writev) may be given
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    # the Linux limit; sysconf is missing or reports no limit
+    IOV_MAX = 1024
+
+def drop_sent(buffers, count, sent):
+    """drop_sent(buffers_deque[u8], count_int, sent_int)
+
+    After a gathered write of the first `count` buffers that wrote `sent`
+    bytes, pop the buffers that were written in full and trim the one that
+    was written in part
+    """
+    for _ in range(count):
+        size = len(buffers[0])
+        if sent < size:
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+            return
+        sent -= size
+        buffers.popleft()
+
+def send_buffers(sock, buffers, flags=0, wait=None):
+    """send_buffers(sock, buffers_list[u8], flags_int, wait_func) -> sent_bool
+
+    Send every buffer in order with gathered writes (sendmsg), so they never
+    have to be copied into one buffer first. When a non-blocking socket is
+    full, `wait` is called; sending stops if it returns False.
+    Returns True once everything has been sent
+    """
+    views = deque(memoryview(buf).cast("B") for buf in buffers)
+    while views:
+        batch = list(islice(views, IOV_MAX))
+        try:
+            sent = sock.sendmsg(batch, (), flags)
+        except BlockingIOError:
+            if wait is None or not wait():
+                return False
+            continue
+        drop_sent(views, len(batch), sent)
+    return True
+
 def get_head(client):
     """get_head(client_socket) -> (head_str, body_u8)
 
-    Create a byte buffer, recv once and check if the response filled the
-    buffer. If it didn't, search for \r\n\r\n (HTTP body start). If found, split
+    recv into a single byte buffer, searching only the newly recvd bytes (and
+    the three before them) for \r\n\r\n (HTTP body start). If found, split
     the byte buffer at that point and return the decoded head, and raw body.
-    If it did, make another buffer to hold what we have so far, and recv
-    until \r\n\r\n is found, or the arbitrary limit 65537 is reached.
+    The buffer is doubled whenever it fills up, until \r\n\r\n is found or
+    the arbitrary limit 65537 is reached.
     Raises --
         NullRequestError if the first recv returns 0 bytes
         HTTPError if 65537 bytes (~65 Kilobytes) are recvd before body is found
+            or the connection closes before then
     Returns ascii decoded head and raw body
     """
     buf = bytearray(BUFSIZE)
-    amt = client.recv_into(buf)
-    if amt < BUFSIZE:
+    size = 0
+    while size < 65537:
+        if size == len(buf):
+            logging.debug("Head overflow")
+            buf.extend(bytes(size))
+        with memoryview(buf) as view:
+            amt = client.recv_into(view[size:])
         if amt == 0:
-            raise NullRequestError
-        else:
-            body_start = buf.find(b"\r\n\r\n")
-            if body_start != -1:
-                head, body = buf[:body_start + 2], buf[body_start + 4:amt]
-                return (decode_http_head(head), body)
-    logging.debug("Head overflow")
-    recvd = bytearray(buf)
-    while len(recvd) < 65537:
-        amt = client.recv_into(buf)
-        recvd.extend(buf[:amt])
-        body_start = recvd.find(b"\r\n\r\n")
+            if size == 0:
+                raise NullRequestError
+            raise HTTPError("Connection closed before the HTTP head ended")
+        search_from = max(0, size - 3)
+        size += amt
+        body_start = buf.find(b"\r\n\r\n", search_from, size)
         if body_start != -1:
-            head, body = recvd[:body_start + 2], recvd[body_start + 4:]
+            head, body = buf[:body_start + 2], buf[body_start + 4:size]
             return (decode_http_head(head), body)
     raise HTTPError("HTTP head too long")
 
+def get_request_length(buf):
+    """get_request_length(buf_u8) -> length_int
+
+    Finds where the first request in `buf` ends, going by its head and its
+    Content-Length.
+    Raises --
+        HTTPError if no head is found in the first 65537 bytes
+        HeaderTypeError if the Content-Length is not a number
+    Returns the request's length, or None if it hasn't been completely recvd
+    """
+    body_start = buf.find(b"\r\n\r\n")
+    if body_start == -1:
+        if len(buf) >= 65537:
+            raise HTTPError("HTTP head too long")
+        return None
+    body_start += 4
+    head = buf[:body_start].lower()
+    start = head.find(b"\r\ncontent-length:")
+    if start == -1:
+        return body_start
+    start += 17
+    end = head.find(b"\r\n", start)
+    return body_start + parse_number("content-length", head[start:end])
+
+class BufferedClient():
+    """BufferedClient() -> BufferedClient
+
+    Stands in for a socket while a request or response that has already been
+    recvd is parsed.
+    """
+    def __init__(self):
+        self.reset(b"")
+
+    def reset(self, request):
+        """reset(request_u8)
+
+        Start reading from the beginning of `request`
+        """
+        self.view = memoryview(request)
+        self.pos = 0
+
+    def recv_into(self, buf, nbytes=0):
+        if not nbytes:
+            nbytes = len(buf)
+        chunk = self.view[self.pos:self.pos + nbytes]
+        buf[:len(chunk)] = chunk
+        self.pos += len(chunk)
+        return len(chunk)
+
+    def recv(self, nbytes):
+        chunk = self.view[self.pos:self.pos + nbytes]
+        self.pos += len(chunk)
+        return bytes(chunk)
+
 class HttpHead():
     """HttpHead(client_sock) -> HttpHead
 
     This class does all the work of parsing an HTTP head. Its primary purpose
     is to serve as a platform for which HttpRequest and HttpResponse stand on.
     """
-    headers = {}
+    __slots__ = ("head", "body", "reqline", "headers")
+
     def __init__(self, client):
+        # still valid if parsing fails below
+        self.headers = {}
         self.head, self.body = get_head(client)
-        reqline = RE_REQLINE.match(self.head)
+        lines = self.head.split("\r\n")
+        reqline = lines[0].split(" ", 2)
         # if we made it this far and the reqline doesn't have three fields, then
         # it must be HTTP/0.9, which this server doesn't support
-        if reqline is None:
+        if len(reqline) != 3:
             raise VersionError
-        self.reqline = (reqline.group(1), reqline.group(2), reqline.group(3))
-        self.headers = parse_headers(self.head)
+        self.reqline = tuple(reqline)
+        self.headers = parse_header_lines(lines[1:])
 
     def recv_body(self, client):
         """recv_body(client_sock)
@@ -147,15 +293,91 @@ class HttpHead():
         specific cases.
         """
         if "content-length" in self.headers:
-            body_len = len(self.body)
-            if body_len < self.headers["content-length"]:
+            length = self.headers["content-length"]
+            offset = len(self.body)
+            if offset < length:
                 logging.debug("Recving body...")
-                nbytes = self.headers["content-length"] - body_len
-                buf = bytearray(BUFSIZE)
-                amt = 0
-                while amt < nbytes:
-                    amt += client.recv_into(buf)
-                    self.body.extend(buf[:amt])
+                # recv straight into the body, after what came with the head
+                body = bytearray(length)
+                body[:offset] = self.body
+                with memoryview(body) as view:
+                    while offset < length:
+                        amt = client.recv_into(view[offset:])
+                        if amt == 0:
+                            raise HTTPError(
+                                "Connection closed before the body ended"
+                            )
+                        offset += amt
+                self.body = body
+
+class _RequestProtocol():
+    """Collects the pieces of a request as httptools parses it"""
+    def __init__(self):
+        self.url = bytearray()
+        self.headers = {}
+        self.body = bytearray()
+        self.head_complete = False
+        self.complete = False
+
+    def on_url(self, url):
+        # the url can arrive split over several recvs
+        if not self.head_complete:
+            self.url.extend(url)
+
+    def on_header(self, name, value):
+        if self.complete:
+            return
+        k = _header_key_u8(name)
+        v = decode_http_head(value)
+        if k in NUMBER_TYPES:
+            v = parse_number(k, v)
+        self.headers[k] = v
+
+    def on_headers_complete(self):
+        self.head_complete = True
+
+    def on_body(self, body):
+        # anything after the first message is dropped, as it is by get_head
+        if not self.complete:
+            self.body.extend(body)
+
+    def on_message_complete(self):
+        self.complete = True
+
+def parse_request(client):
+    """parse_request(client_sock) -> (parser, _RequestProtocol)
+
+    Feed the request to an httptools parser until the whole message (head and
+    body) has been recvd.
+    Raises --
+        NullRequestError if the first recv returns 0 bytes
+        HTTPError if the request is malformed, the client hangs up early, or
+            65537 bytes (~65 Kilobytes) are recvd before the body is found
+        HeaderTypeError if a header has the wrong type
+    Returns the parser and the parsed request
+    """
+    protocol = _RequestProtocol()
+    parser = httptools.HttpRequestParser(protocol)
+    buf = bytearray(BUFSIZE)
+    view = memoryview(buf)
+    recvd = 0
+    while not protocol.complete:
+        amt = client.recv_into(buf)
+        if amt == 0:
+            if recvd == 0:
+                raise NullRequestError
+            raise HTTPError("Connection closed before the request ended")
+        recvd += amt
+        try:
+            parser.feed_data(view[:amt])
+        except httptools.HttpParserCallbackError as e:
+            # re-raise whatever our own callbacks raised
+            raise e.__context__
+        except httptools.HttpParserError as e:
+            raise HTTPError(str(e))
+        if not protocol.head_complete and recvd >= 65537:
+            raise HTTPError("HTTP head too long")
+    return parser, protocol
 
 class HttpRequest(HttpHead):
     """HttpRequest(client_sock) -> HttpRequest
@@ -165,14 +387,38 @@ class HttpRequest(HttpHead):
         url, ('/')
         proto, ('HTTP/1.1')
         headers, (as a dictionary)
-        head, (as a string)
+        head, (as a string, None when parsed by httptools)
         and body. (as a bytearray)
     """
+    __slots__ = ("req_type", "url", "proto")
+
     def __init__(self, client):
-        HttpHead.__init__(self, client)
-        self.req_type, self.url, self.proto = self.reqline
-        if self.req_type == "POST":
-            self.recv_body(client)
+        self.parse(client)
+
+    def parse(self, client):
+        """parse(client_sock)
+
+        Parse the next request from `client` into this HttpRequest, replacing
+        the last one. Keep-alive connections reuse one HttpRequest this way.
+        """
+        if httptools is None:
+            HttpHead.__init__(self, client)
+            self.req_type, self.url, self.proto = self.reqline
+            if self.req_type == "POST":
+                self.recv_body(client)
+            return
+        parser, protocol = parse_request(client)
+        version = parser.get_http_version()
+        # HTTP/0.9 has no version in its request line
+        if version == "0.9":
+            raise VersionError
+        self.head = None
+        self.req_type = _method_name(parser.get_method())
+        self.url = decode_http_head(protocol.url)
+        self.proto = "HTTP/" + version
+        self.reqline = (self.req_type, self.url, self.proto)
+        self.headers = protocol.headers
+        self.body = protocol.body
 
 class HttpResponse(HttpHead):
     """HttpResponse(client_sock) -> HttpResponse
@@ -185,6 +431,8 @@ class HttpResponse(HttpHead):
         head, (as a string)
         and body. (as a bytearray)
     """
+    __slots__ = ("proto", "code", "message")
+
     def __init__(self, client):
         HttpHead.__init__(self, client)
         self.proto, self.code, self.message = self.reqline
@@ -1,11 +1,16 @@
 import os
+import socket
 import logging
-from select import select
-from time import gmtime, strftime
+from collections import deque
+from time import time, gmtime, strftime
 
 PROTOCOL_VERSION = "HTTP/1.1"
 ENCODING = ("utf-8", "replace")
 
+# Linux only; without them the head is simply sent in its own packet
+_TCP_CORK = getattr(socket, "TCP_CORK", None)
+_MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
 RESPONSES = {
     100: "Continue",
     101: "Switching Protocols",
@@ -139,6 +144,18 @@ EXT_MAP = {
     ".wmv": "video/x-ms-wmv",
 }
 
+# every response's status line, already encoded
+STATUS_LINES = {
+    code: ("%s %s %s\r\n" % (PROTOCOL_VERSION, code, msg)).encode("ascii")
+    for code, msg in RESPONSES.items()
+}
+STATIC_HEAD = (
+    b"Cache-Control: max-age=86400\r\n"
+    b"Server: ZeroMasterHTTP/1.0\r\n"
+)
+KEEP_ALIVE_END = b"Connection: keep-alive\r\n\r\n"
+CLOSE_END = b"Connection: close\r\n\r\n"
+
 def guess_type(fpath):
     """guess_type(fpath_str) -> type_str
 
@@ -152,6 +169,21 @@ def guess_type(fpath):
     else:
         return "application/octet-stream"
 
+# Content-Type header lines for each extension, already encoded
+EXT_HEADERS = {
+    ext: ("Content-Type: %s\r\n" % ctype).encode("ascii")
+    for ext, ctype in EXT_MAP.items()
+}
+DEFAULT_TYPE_HEADER = b"Content-Type: application/octet-stream\r\n"
+
+def guess_type_header(fpath):
+    """guess_type_header(fpath_str) -> content_type_line_u8
+
+    Like guess_type, but returns the whole encoded Content-Type header line
+    """
+    ext = fpath[fpath.rfind('.'):].lower()
+    return EXT_HEADERS.get(ext, DEFAULT_TYPE_HEADER)
+
 def gmtime_str(timestamp=None):
     """gmtime_str(timestamp_float) -> gmtime_str
 
@@ -159,26 +191,136 @@ def gmtime_str(timestamp=None):
     """
     return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(timestamp))
 
+# (second, Date header line) for the last second a head was made in
+_date_cache = (0, b"")
+
+def date_header():
+    """date_header() -> date_line_u8
+
+    Returns the encoded `Date: ...` header line for the current second. It
+    only changes once a second, so it is only formatted once a second.
+    """
+    global _date_cache
+    now = int(time())
+    cached_at, line = _date_cache
+    if now != cached_at:
+        line = ("Date: %s\r\n" % gmtime_str(now)).encode("ascii")
+        # swapped in as a single tuple, so other threads never see half an
+        # update
+        _date_cache = (now, line)
+    return line
+
+def _set_cork(client, value):
+    if _TCP_CORK is None:
+        return False
+    try:
+        client.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, value)
+    except OSError:
+        return False
+    return True
+
+class FileBody():
+    """FileBody(file, size_int) -> FileBody
+
+    A file queued behind its head by ServerClient.write_file. The server sends
+    it a piece at a time, as the client accepts it, keeping track of how much
+    has been sent in `offset`.
+    """
+    def __init__(self, fin, size):
+        self.fin = fin
+        self.size = size
+        self.offset = 0
+        self.corked = None
+        self.use_sendfile = hasattr(os, "sendfile")
+
+    def send(self, client):
+        """send(client_sock) -> done_bool
+
+        Send as much of the file as `client` takes without blocking.
+        Raises OSError if the file ends before `size` bytes have been sent
+        Returns True once the whole file has been sent
+        """
+        if self.corked is None:
+            # hold back partial packets so the head goes out together with
+            # the start of the file
+            self.corked = _set_cork(client, 1)
+        while self.offset < self.size:
+            try:
+                sent = self.__send_chunk(client)
+            except BlockingIOError:
+                return False
+            if sent == 0:
+                raise OSError("File ended before its Content-Length")
+            self.offset += sent
+        self.close(client)
+        return True
+
+    def __send_chunk(self, client):
+        if self.use_sendfile:
+            try:
+                # let the kernel copy the file straight to the socket
+                return os.sendfile(
+                    client.fileno(), self.fin.fileno(),
+                    self.offset, self.size - self.offset
+                )
+            except BlockingIOError:
+                raise
+            except OSError as e:
+                # not for this socket or file
+                logging.debug("sendfile failed: %s", e)
+                self.use_sendfile = False
+        self.fin.seek(self.offset)
+        buf = self.fin.read(min(65536, self.size - self.offset))
+        if not buf:
+            return 0
+        return client.send(buf)
+
+    def close(self, client):
+        """close(client_sock)
+
+        Close the file, whether or not all of it was sent
+        """
+        if self.corked:
+            _set_cork(client, 0)
+            self.corked = False
+        self.fin.close()
+
 class ServerClient:
-    """ServerClient(req_HttpRequest, client_sock, addr) -> ServerClient
+    """ServerClient(req_HttpRequest, client_sock, addr, [out_deque])
+        -> ServerClient
 
-    An interface for handling HTTP/1.0 and HTTP/1.1 clients
+    An interface for handling HTTP/1.0 and HTTP/1.1 clients. Responses are
+    only queued on `out` (buffers and FileBodys); the server sends them as the
+    client accepts them.
     """
-    def __init__(self, req, client, addr):
+    def __init__(self, req, client, addr, out=None):
+        self.client = client
+        self.ip, self.port = addr
+        self.out = deque() if out is None else out
+        self.reset(req)
+
+    def reset(self, req):
+        """reset(req_HttpRequest)
+
+        Prepare to respond to `req`, the next request on this connection.
+        `req` is None when the request couldn't be parsed, in which case the
+        connection is not kept alive.
+        """
         self.keep_alive = False
+        self.req = req
+        if req is None:
+            return
         str_version = req.proto.split('/', 1)[1]
         version = tuple(int(n) for n in str_version.split('.'))
         if version >= (1, 1) and "connection" in req.headers:
             if req.headers["connection"] == "keep-alive":
                 self.keep_alive = True
-        self.req = req
-        self.client = client
-        self.ip, self.port = addr
 
-    def make_head(self, scode, headers_dict):
-        """make_head(scode_int, headers_dict) -> head_u8
+    def make_head(self, scode, headers_dict, raw_headers=b""):
+        """make_head(scode_int, headers_dict, raw_headers_u8) -> head_u8
 
-        Creates the HTTP head used to respond to the client
+        Creates the HTTP head used to respond to the client. raw_headers is
+        optional and is copied into the head as is.
 
         Includes headers --
             Server: ZeroMasterHTTP/1.0
@@ -186,20 +328,17 @@ class ServerClient:
             Connection: close or keep-alive depending on the value of
                 self.keep_alive
         """
-        head = bytearray(
-            "%s %s %s\r\n" % (PROTOCOL_VERSION, scode, RESPONSES[scode]),
-            "ascii"
-        )
-        head.extend(b"Cache-Control: max-age=86400\r\n")
-        head.extend(b"Server: ZeroMasterHTTP/1.0\r\n")
-        head.extend(("Date: %s\r\n" % gmtime_str()).encode("ascii"))
+        head = bytearray(STATUS_LINES[scode])
+        head.extend(STATIC_HEAD)
+        head.extend(date_header())
+        head.extend(raw_headers)
         if headers_dict is not None:
             for header in headers_dict.items():
                 head.extend(("%s: %s\r\n" % header).encode("ascii"))
         if self.keep_alive:
-            head.extend(b"Connection: keep-alive\r\n\r\n")
+            head.extend(KEEP_ALIVE_END)
         else:
-            head.extend(b"Connection: close\r\n\r\n")
+            head.extend(CLOSE_END)
         return head
 
     def write_file(self, fpath, other_headers=None):
@@ -207,51 +346,56 @@ class ServerClient:
 
         other_headers is optional
 
-        Attempts the send an entire file to the client.
-        Upon failure, this will force keep_alive to False
+        Queues an entire file to be sent to the client. The file is kept open
+        until it has been sent or the connection is closed.
         """
-        with open(fpath, "rb") as fin:
+        fin = open(fpath, "rb")
+        try:
             fs = os.fstat(fin.fileno())
             headers = {
                 "Content-Length": str(fs[6]),
                 "Last-Modified": gmtime_str(fs.st_mtime),
-                "Content-Type": guess_type(fpath)
             }
+            type_header = b""
             if other_headers is not None:
                 headers.update(other_headers)
-            self.client.send(self.make_head(200, headers))
-            while True:
-                buf = fin.read(8192)
-                if not buf:
-                    break
-                # if this times out, the sent file will be corrupted
-                _, wlist, _ = select([], [self.client], [], 5.0)
-                if self.client in wlist:
-                    self.client.sendall(buf)
-                else:
-                    # in that case, give up
-                    logging.error("Connection with `%s` timed out" % self.ip)
-                    self.keep_alive = False
-                    break
+            if "Content-Type" not in headers:
+                type_header = guess_type_header(fpath)
+            head = self.make_head(200, headers, type_header)
+        except:
+            fin.close()
+            raise
+        self.out.append(head)
+        self.out.append(FileBody(fin, fs.st_size))
 
     def write_body(self, scode, ctype, body, other_headers=None):
         """write_body(scode_int, ctype_str, body_u8, other_headers_dict)
 
         other_headers is optional
         ctype is the Content-Type header value, scode is the response code
+        body may also be a str, which is encoded as utf-8
 
-        Writes a string originating from within Python to the client. For
-        writing files, write_file should be used instead.
+        Queues a string originating from within Python to be written to the
+        client. For writing files, write_file should be used instead.
         """
+        # the body is only sent once the handler has returned, so make sure
+        # it can be sent now
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        elif isinstance(body, memoryview):
+            body = body.cast("B")
+        elif not isinstance(body, (bytes, bytearray)):
+            raise TypeError(
+                "body must be bytes-like or str, not %s" % type(body).__name__
+            )
         headers_dict = {}
         headers_dict["Content-Type"] = ctype
         headers_dict["Content-Length"] = len(body)
         if other_headers is not None:
             headers_dict.update(other_headers)
-        output_u8 = self.make_head(scode, headers_dict)
-        output_u8.extend(body)
-        self.client.sendall(output_u8)
-        logging.debug("Body sent!")
+        self.out.append(self.make_head(scode, headers_dict))
+        self.out.append(body)
+        logging.debug("Body queued")
 
     def write_generic_body(self, scode, body=None):
         """write_body(scode_int, ctype_str, body_u8, other_headers_dict)
@@ -279,7 +423,7 @@ class ServerClient:
 
         headers_dict is optional
 
-        Write the http head with response code `scode` to the client
+        Queue the http head with response code `scode` to be written to the
+        client
         """
-        output_u8 = self.make_head(scode, headers_dict)
-        self.client.sendall(output_u8)
+        self.out.append(self.make_head(scode, headers_dict))
@@ -1,10 +1,21 @@
 import re
 import os
 import json
+import inspect
 import logging
-from hashlib import md5
+from string import Formatter
+from hashlib import blake2b
+from itertools import islice
+from collections import deque
+
+try:
+    # faster than hashlib on large inputs, when it is installed
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
 
 from . import WEB_PATH
+from .httpbase.httputil import IOV_MAX, drop_sent
 
 SERVICE_PATH = "services"
 
@@ -86,6 +97,61 @@ TEMPLATE_PAGE = """
 </html>
 """
 
+def compile_template(template):
+    """compile_template(template_str) -> parts_tuple
+
+    Split a str.format template into its utf-8 encoded literal text and field
+    names once, so that filling it in with render is a single join
+    """
+    return tuple(
+        (literal.encode("utf-8"), field)
+        for literal, field, _, _ in Formatter().parse(template)
+    )
+
+def render_parts(parts, fields):
+    """render_parts(parts_tuple, fields_dict) -> chunks_list[u8]
+
+    Fill in a template compiled with compile_template. bytes fields are
+    referenced as they are, anything else is converted to a utf-8 str.
+    """
+    out = []
+    for literal, field in parts:
+        out.append(literal)
+        if field is not None:
+            value = fields[field]
+            if not isinstance(value, bytes):
+                value = str(value).encode("utf-8")
+            out.append(value)
+    return out
+
+def render(parts, fields):
+    """render(parts_tuple, fields_dict) -> u8
+
+    Like render_parts, joined into one bytes object
+    """
+    return b"".join(render_parts(parts, fields))
+
+PAGE_PARTS = compile_template(TEMPLATE_PAGE)
+SERVICE_ITEM_PARTS = compile_template(TEMPLATE_SERVICE_ITEM)
+DEV_INFO_PARTS = compile_template(TEMPLATE_DEV_INFO)
+SIDE_PARTS = compile_template(TEMPLATE_SIDE)
+# hard code this for now, but not in the future
+SFW_INFO = TEMPLATE_SFW_INFO.format(version="1.0").encode("utf-8")
+
+def render_page(title, selected, sidebar, body):
+    """render_page(title_str, selected_str, sidebar_u8, body_u8)
+        -> chunks_list[u8]
+
+    Render a whole page as a list of chunks for write_file. The sidebar is
+    shared by every page, so it is referenced rather than copied into each.
+    """
+    return render_parts(PAGE_PARTS, dict(
+        title=title,
+        selected=selected,
+        sidebar=sidebar,
+        body=body
+    ))
+
 def _write_hashes(hashes):
     cachepath = os.path.join(WEB_PATH, "serializercache.json")
     with open(cachepath, "w") as fout:
@@ -97,25 +163,100 @@ def _load_hashes():
         with open(cachepath, "r") as fin:
             hashes = json.load(fin)
     else:
-        hashes = []
+        hashes = {}
+    # caches written before sources were tracked are lists of hashes
+    if not isinstance(hashes, dict):
+        hashes = {}
     return hashes
 
+_PACKAGE = __name__.partition(".")[0]
+
+def _get_source_mtime(obj):
+    """_get_source_mtime(obj) -> mtime_float
+
+    Returns the modification time of the file that defines obj's class, or
+    None if it can't be found (e.g. the class was defined interactively)
+    """
+    if obj.__class__.__module__.partition(".")[0] == _PACKAGE:
+        # built straight from Service or BaseDevice, so its contents come
+        # from wherever it was made, not from the file of its class
+        return None
+    try:
+        return os.path.getmtime(inspect.getfile(obj.__class__))
+    except (TypeError, OSError):
+        return None
+
+def _is_fresh(old_hashes, new_hashes, name, obj):
+    """_is_fresh(old_hashes_dict, new_hashes_dict, name_str, obj) -> bool
+
+    Records obj's [hash, source_mtime] in new_hashes under name. If the file
+    that defines obj has not been modified since the last run, obj is assumed
+    to be unchanged and is not hashed at all.
+    Returns True if obj was serialized last run and has not changed since
+    """
+    mtime = _get_source_mtime(obj)
+    old = old_hashes.get(name)
+    if old is not None and mtime is not None and old[1] == mtime:
+        new_hashes[name] = old
+        return True
+    _hash = _get_hash(obj)
+    new_hashes[name] = [_hash, mtime]
+    return old is not None and old[0] == _hash
+
 def _get_hash(obj):
-    return md5(str(obj).encode("utf-8")).hexdigest()
+    """_get_hash(obj) -> hash_str
+
+    Fingerprint a device or service by its values_dict, one entry at a time,
+    rather than building and encoding its whole repr first. The hashes are
+    only used to skip regenerating unchanged pages.
+    """
+    if blake3 is not None:
+        hasher = blake3()
+    else:
+        hasher = blake2b(digest_size=16)
+    for key, value in sorted(obj.values_dict().items()):
+        hasher.update(key.encode("utf-8"))
+        hasher.update(json.dumps(value, sort_keys=True).encode("utf-8"))
+    return hasher.digest()[:16].hex()
+
+def write_file(path, content, pending):
+    """write_file(path_str, content_str|content_u8|chunks_list[u8],
+                  pending_list)
+
+    Queue `content` on `pending` to be written to `path` after `path` has
+    been joined to `WEB_PATH`. Nothing is written until flush_writes is
+    called with `pending`.
+    """
+    if isinstance(content, str):
+        content = [content.encode("utf-8")]
+    elif isinstance(content, bytes):
+        content = [content]
+    pending.append((os.path.join(WEB_PATH, path), content))
+
+def _write_chunks(fd, chunks):
+    # write every chunk with gathered writes, trimming a partly written one
+    chunks = deque(chunks)
+    while chunks:
+        batch = list(islice(chunks, IOV_MAX))
+        drop_sent(chunks, len(batch), os.writev(fd, batch))
 
-def write_file(path, content):
-    """write_file(path_str, content_str)
+def flush_writes(pending):
+    """flush_writes(pending_list)
 
-    Write `content` to `path` after `path` has been joined to `WEB_PATH`
+    Write every file queued on `pending` by write_file, creating each
+    directory only once
     """
-    path = os.path.join(WEB_PATH, path)
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    with open(path, "w") as fout:
-        fout.write(content)
+    for dirname in {os.path.dirname(path) for path, _ in pending}:
+        os.makedirs(dirname, exist_ok=True)
+    for path, content in pending:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _write_chunks(fd, content)
+        finally:
+            os.close(fd)
 
 def create_docblock(service, serivce_type):
-    """create_docblock(service_Service, serivce_type_str)
+    """create_docblock(service_Service, serivce_type_str) -> docblock_u8
 
     Creates docblock that explains the service event or service method
     """
@@ -129,12 +270,14 @@ def create_docblock(service, serivce_type):
         returns = '\n'.join(map(str, service.sends.values()))
     if service.__doc__ != "":
         docstring = RE_VAR.sub(SU_VAR, service.__doc__)
-    return TEMPLATE_SERVICE_ITEM.format(**locals())
+    return render(SERVICE_ITEM_PARTS, locals())
 
-def serialize_service(sidebar, device_name, service):
-    """serialize_service(sidebar_str, device_name_str, service_Service)
+def serialize_service(sidebar, device_name, service, pending):
+    """serialize_service(sidebar_u8, device_name_str, service_Service,
+                         pending_list)
 
-    Serializes the service, creating the .json and .html representations of it
+    Serializes the service, queueing the .json and .html representations of
+    it on `pending`
     """
     docstring = [
         create_docblock(method, "Service Method")
@@ -144,11 +287,11 @@ def serialize_service(sidebar, device_name, service):
         create_docblock(event, "Service Event")
         for event in service.events.values()
     ))
-    docstring = TEMPLATE_PAGE.format(
-        title=" - ".join((device_name, service.name)),
-        selected=service.name,
-        sidebar=sidebar,
-        body='\n'.join(docstring)
+    docstring = render_page(
+        " - ".join((device_name, service.name)),
+        service.name,
+        sidebar,
+        b'\n'.join(docstring)
     )
     write_file(
         os.path.join(
@@ -156,44 +299,45 @@ def serialize_service(sidebar, device_name, service):
             service.name,
             "index.html"
         ),
-        docstring
+        docstring,
+        pending
     )
-    write_file(service.spec_url, json.dumps(service.values_dict()))
+    write_file(service.spec_url, service.spec_json, pending)
 
-def serialize_device(sidebar, device):
-    """serialize_device(sidebar_str, device_BaseDevice)
+def serialize_device(sidebar, device, pending):
+    """serialize_device(sidebar_u8, device_BaseDevice, pending_list)
 
-    Serializes the device, creating the .json and .html representations of it
+    Serializes the device, queueing the .json and .html representations of it
+    on `pending`
     """
-    body = '\n'.join((
-        TEMPLATE_DEV_INFO.format(
+    body = b'\n'.join((
+        render(DEV_INFO_PARTS, dict(
             device_name=device.name,
             device_type=device.device_type,
             urn=device.urn,
             mac_address=device.mac_address
-        ),
-        # hard code this for now, but not in the future
-        TEMPLATE_SFW_INFO.format(version="1.0")
+        )),
+        SFW_INFO
     ))
-    body = TEMPLATE_PAGE.format(
-        title=" - ".join((device.name, "Device Info")),
-        selected="Device Info",
-        sidebar=sidebar,
-        body=body
+    body = render_page(
+        " - ".join((device.name, "Device Info")),
+        "Device Info",
+        sidebar,
+        body
     )
-    write_file("index.html", body)
-    write_file("setup.json", json.dumps(device.values_dict()))
+    write_file("index.html", body, pending)
+    write_file("setup.json", json.dumps(device.values_dict()), pending)
 
 def create_side(services):
-    """create_side(services_list[Service])
+    """create_side(services_list[Service]) -> sidebar_u8
 
     Creates the sidebar for the web page
     """
     sidebar = (
-        TEMPLATE_SIDE.format(path=SERVICE_PATH, name=svc.name)
+        render(SIDE_PARTS, dict(path=SERVICE_PATH, name=svc.name))
         for svc in services
     )
-    return '\n'.join(sidebar)
+    return b'\n'.join(sidebar)
 
 def serialize(device):
     """serialize(device_BaseDevice)
@@ -201,19 +345,19 @@ def serialize(device):
     Serializes all parts of the device into .json and .html representations
     """
     old_hashes = _load_hashes()
-    new_hashes = []
+    new_hashes = {}
     sidebar = create_side(device.services)
+    # nothing is written unless every stale page rendered
+    pending = []
     for service in device.services:
-        _hash = _get_hash(service)
-        new_hashes.append(_hash)
-        if _hash in old_hashes:
-            logging.debug("Skipping %s serialization" % service.name)
+        key = "service:" + service.name
+        if _is_fresh(old_hashes, new_hashes, key, service):
+            logging.debug("Skipping %s serialization", service.name)
             continue
-        serialize_service(sidebar, device.name, service)
-    _hash = _get_hash(device)
-    new_hashes.append(_hash)
-    if _hash not in old_hashes:
-        serialize_device(sidebar, device)
+        serialize_service(sidebar, device.name, service, pending)
+    if not _is_fresh(old_hashes, new_hashes, "device:" + device.name, device):
+        serialize_device(sidebar, device, pending)
     else:
         logging.debug("Skipping device serialization")
+    flush_writes(pending)
     _write_hashes(new_hashes)
@@ -1,11 +1,12 @@
 import socket
 import logging
 from struct import pack
+from functools import lru_cache
 from select import select
 from threading import Thread
-from time import gmtime, strftime
 
 from .httpbase import httputil, LISTEN_TIMEOUT
+from .httpbase.serverclient import date_header
 from ..utils import get_address
 
 MCAST_ADDR = "239.255.255.250"
@@ -21,16 +22,32 @@ SV: iotscp:discover
 
 """
 
+# The discovery head as devicefinder sends it
+DISCOVER_HEAD = (
+    "IOT-SEARCH * HTTP/1.1\r\n"
+    "Host: 239.255.255.250:1900\r\n"
+    "Return: device; type=basedevice\r\n"
+    "SV: iotscp:discover\r\n"
+    "\r\n"
+)
+
 # This is bare bones right now. In the future, I want the
 # return header to be more useful as a query operator
 # for example: "supports; method=setbinarystate" to get devices
 # that implement `setbinarystate`
+@lru_cache(maxsize=64)
 def should_respond(head_str):
     """should_respond(head_str) -> should_respond_bool
 
     Determines, based on information in the response head, weither or not the
     UDPServer should respond to a client
     """
+    # hosts keep resending the same few searches, so the common cases are
+    # answered without the regex (and the result is cached on top of that)
+    if not head_str.startswith("IOT-SEARCH "):
+        return False
+    if head_str == DISCOVER_HEAD:
+        return True
     reqline = httputil.RE_REQLINE.match(head_str)
     if reqline is not None and reqline.group(1) == "IOT-SEARCH":
         headers = httputil.parse_headers(head_str)
@@ -41,7 +58,7 @@ def should_respond(head_str):
     return False
 
 class UDPServer():
-    """UDPServer(server_port, stop_event, [interface_str]) -> UDPServer
+    """UDPServer(stop_StopFlag, server_port, [interface_str]) -> UDPServer
 
     This class is used to listen for discovery requests made on
     `MCAST_ADDR`:`MCAST_PORT`. When a valid request is made, the server responds
@@ -51,14 +68,17 @@ class UDPServer():
     def __init__(self, stop, server_port, interface=""):
         self.stop = stop
         self.interface = interface
-        self.response = "\r\n".join((
-            "HTTP/1.1 200 OK",
-            "Date: {}",
-            "Location: http://%s:%s/setup.json" % (get_address(), server_port),
-            "Server: ZeroMasterUDP/1.0, IOTSCP/1.0",
-            "",
-            ""
-        ))
+        # %s is filled in with the Date header line
+        self.response = (
+            b"HTTP/1.1 200 OK\r\n"
+            b"%s"
+            + ("Location: http://%s:%s/setup.json\r\n"
+               % (get_address(), server_port)).encode("ascii")
+            + b"Server: ZeroMasterUDP/1.0, IOTSCP/1.0\r\n"
+            b"\r\n"
+        )
+        # (date_line_u8, response_u8) for the last second a response was sent
+        self.__cached = (None, None)
 
     def bind(self):
         """Add this udp socket to the multicast group for listening"""
@@ -74,26 +94,47 @@ class UDPServer():
             socket.IP_ADD_MEMBERSHIP,
             pack("4sl", socket.inet_aton(MCAST_ADDR), socket.INADDR_ANY)
         )
+        self.udpsock.setblocking(False)
 
     def listen(self):
         """Accepts requests until `self.stop` is set"""
-        while not self.stop.is_set():
+        while not self.stop.stopped:
             rlist, _, _ = select([self.udpsock], [], [], LISTEN_TIMEOUT)
             if self.udpsock in rlist:
-                try:
-                    data, addr = self.udpsock.recvfrom(4096)
-                    if should_respond(data.decode("ascii")):
-                        response_str = self.response.format(
-                            strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
-                        )
-                        self.udpsock.sendto(
-                            bytearray(response_str, "ascii"),
-                            addr
-                        )
-                except Exception as e:
-                    logging.error(e)
+                self._handle_pending()
         self._shutdown()
 
+    def _handle_pending(self):
+        """Responds to every datagram waiting on the socket, not just one per
+        wake up
+        """
+        while True:
+            try:
+                data, addr = self.udpsock.recvfrom(4096)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                logging.error(e)
+                return
+            try:
+                if should_respond(data.decode("ascii")):
+                    self.udpsock.sendto(self._get_response(), addr)
+            except Exception as e:
+                logging.error(e)
+
+    def _get_response(self):
+        """_get_response() -> response_u8
+
+        The response only changes when its Date header does, once a second,
+        so it is filled in at most once a second
+        """
+        date_line = date_header()
+        cached_line, response = self.__cached
+        if date_line is not cached_line:
+            response = self.response % date_line
+            self.__cached = (date_line, response)
+        return response
+
     def start(self):
         """Starts the server, binds it, and calls `listen` on a new thread"""
         self.bind()
@@ -1,15 +1,45 @@
 import json
 import socket
+from threading import Lock
 
+from .utils import get_algorithms
 from .core.scsession import SCSession
-from .http.httpbase.httputil import HttpResponse
+from .http.httpbase.httputil import (
+    HttpResponse, NullRequestError, send_buffers
+)
 
-try:
-    from hashlib import algorithms
-except ImportError:
-    from hashlib import algorithms_available as algorithms
+ALGORITHMS = get_algorithms()
 
 _HELLO_URL = "/iotscp/hello"
+# the algorithms offered never change, so the hello body is only encoded once
+_HELLO_TEMPLATE = (
+    b'{"offset":%d,"algorithms":'
+    + json.dumps(ALGORITHMS, separators=(",", ":")).encode("utf-8")
+    + b'}'
+)
+
+_REQUEST_TEMPLATE = (
+    b"%s %s HTTP/1.1\r\n"
+    b"uuid: %s\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+)
+
+def make_request(req_type, url, uuid, data):
+    """make_request(req_type_u8, url_str, uuid_str, data_u8) -> (head_u8, data)
+
+    Create the head of a HTTP request carrying `data` as its body. The head
+    and body are sent together without being joined.
+    """
+    head = _REQUEST_TEMPLATE % (
+        req_type,
+        url.encode("ascii"),
+        uuid.encode("ascii"),
+        len(data)
+    )
+    return (head, data)
 
 class SCDeviceError(Exception):
     """Raised as a catch-all to describe errors in the SCDevice class"""
@@ -26,15 +56,49 @@ class SCDevice():
     def __init__(self, addr, dev_json, cert):
         self.addr = addr
         self.cert = cert
-        self.session = self.__get_session()
+        # one keep-alive connection is shared by every request to the device
+        self.__sock = None
+        self.__lock = Lock()
+        try:
+            self.session = self.__get_session()
+        except:
+            self.close()
+            raise
         for k, v in dev_json.items():
             setattr(self, k, v)
 
+    def __request(self, msg):
+        if self.__sock is None:
+            self.__sock = socket.create_connection(self.addr)
+        send_buffers(self.__sock, msg)
+        return HttpResponse(self.__sock)
+
+    # callers hold __lock (except during __init__), which also keeps the
+    # session's key in step with the order requests reach the device
     def __send(self, msg):
-        sock = socket.socket()
-        sock.connect(self.addr)
-        sock.sendall(msg)
-        return HttpResponse(sock)
+        reused = self.__sock is not None
+        try:
+            res = self.__request(msg)
+        except (OSError, NullRequestError):
+            self.__drop()
+            if not reused:
+                raise
+            # the device probably closed the idle connection, so try once
+            # more on a new one
+            res = self.__request(msg)
+        if res.headers.get("connection") != "keep-alive":
+            self.__drop()
+        return res
+
+    def __drop(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+    def close(self):
+        """Closes the connection to the device, if there is one"""
+        with self.__lock:
+            self.__drop()
 
     def __get_session(self):
         """Starts an authenticated session with the device
@@ -44,23 +108,11 @@ class SCDevice():
                 algorithm (only a MITM should cause this, so beware!)
         """
         cert = self.cert
-        data = json.dumps(dict(
-            offset=cert.offset,
-            algorithms=algorithms
-        ))
-        req = "\r\n".join((
-            "POST %s HTTP/1.1" % _HELLO_URL,
-            "uuid: %s" % cert.uuid,
-            "Content-Type: application/json",
-            "Content-Length: %d" % len(data),
-            "Connection: close",
-            "",
-            data
-        ))
-        res = self.__send(req)
+        data = _HELLO_TEMPLATE % cert.offset
+        res = self.__send(make_request(b"POST", _HELLO_URL, cert.uuid, data))
         if res.code == 200:
             algorithm = res.body.decode("utf-8")
-            if algorithm not in algorithms:
+            if algorithm not in ALGORITHMS:
                 raise SCDeviceError(
                     "Algorithm %s is not available" % algorithm)
             return SCSession(cert, algorithm)
@@ -76,23 +128,20 @@ class SCDevice():
         Raises --
             SCDeviceError when the response code is not 200 OK
         """
-        data = self.session.encrypt(json.dumps([method_name, args or {}]))
-        req = bytearray("\r\n".join((
-            "POST %s HTTP/1.1" % control_url,
-            "uuid: %s" % self.cert.uuid,
-            "Content-Type: application/json",
-            "Content-Length: %d" % len(data),
-            "Connection: close",
-            "", ""
-        )), "ascii")
-        req.extend(data)
-        res = self.__send(req)
-        if res.code == 200:
+        # the session's key changes with every message, so the whole exchange
+        # has to happen without another request getting in between
+        with self.__lock:
+            data = self.session.encrypt(
+                json.dumps([method_name, args or {}])
+            )
+            res = self.__send(
+                make_request(b"POST", control_url, self.cert.uuid, data)
+            )
+            if res.code != 200:
+                raise SCDeviceError("Device responded with %d" % res.code)
             self.session.update_key()
             body = self.session.decrypt(res.body)
-            return json.loads(body)
-        else:
-            raise SCDeviceError("Device responded with %d" % res.code)
+        return json.loads(body)
 
     def subscribe(self, event_url, port):
         """subscribe(event_url_str, port_int)
@@ -103,18 +152,11 @@ class SCDevice():
         Raises --
             SCDeviceError when the response code is not 200 OK
         """
-        data = self.session.encrypt(json.dumps(dict(port=port)))
-        req = bytearray("\r\n".join((
-            "SUBSCRIBE %s HTTP/1.1" % event_url,
-            "uuid: %s" % self.cert.uuid,
-            "Content-Type: application/json",
-            "Content-Length: %d" % len(data),
-            "Connection: close",
-            "", ""
-        )), "ascii")
-        req.extend(data)
-        res = self.__send(req)
-        if res.code == 200:
+        with self.__lock:
+            data = self.session.encrypt(json.dumps(dict(port=port)))
+            res = self.__send(
+                make_request(b"SUBSCRIBE", event_url, self.cert.uuid, data)
+            )
+            if res.code != 200:
+                raise SCDeviceError("Device responded with %d" % res.code)
             self.session.update_key()
-        else:
-            raise SCDeviceError("Device responded with %d" % res.code)
@@ -1,5 +1,24 @@
-from time import time
-from datetime import timedelta
+from time import perf_counter
+from functools import lru_cache
+
+_DEFAULT_ALLOWED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-"
+)
+
+@lru_cache(maxsize=32)
+def _get_allowed(blacklist, whitelist):
+    # (allowed_set, allowed_u8); allowed_u8 is None when non-ascii characters
+    # are allowed, since bytes.translate can't check for those
+    allowed = set(_DEFAULT_ALLOWED)
+    if whitelist is not None:
+        allowed.update(whitelist)
+    if blacklist is not None:
+        allowed -= blacklist
+    try:
+        allowed_u8 = "".join(allowed).encode("ascii")
+    except UnicodeEncodeError:
+        allowed_u8 = None
+    return (allowed, allowed_u8)
 
 def verify_str(_str, str_name, blacklist=None, whitelist=None):
     """verify_str(str_str, str_name_str, blacklist_set, whitelist_set)
@@ -7,25 +26,28 @@ def verify_str(_str, str_name, blacklist=None, whitelist=None):
 
     Raises ValueError if an illegal character is found
     """
-    allowed = set(
-        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-"
+    allowed, allowed_u8 = _get_allowed(
+        None if blacklist is None else frozenset(blacklist),
+        None if whitelist is None else frozenset(whitelist)
     )
-    if whitelist is not None:
-        allowed.update(whitelist)
-    if blacklist is not None:
-        allowed -= blacklist
+    if allowed_u8 is not None:
+        # deleting every allowed byte in C leaves only the illegal ones
+        try:
+            if not _str.encode("ascii").translate(None, allowed_u8):
+                return
+        except UnicodeEncodeError:
+            pass
+    # find the first illegal character for the error message
     for c in _str:
         if c not in allowed:
             raise ValueError("`%s` is not allowed in %s" % (c, str_name))
 
+@lru_cache(maxsize=1)
 def get_algorithms():
-    """Returns an organized list of this machine's hashing algorithms
+    """Returns an organized tuple of this machine's hashing algorithms
     (Ideally organized by strength, but I am not a cryptography expert)
     """
-    try:
-        from hashlib import algorithms
-    except ImportError:
-        from hashlib import algorithms_available as algorithms
+    from hashlib import algorithms_available as algorithms
     sorted_algs = [
         "sha512", "SHA512",
         "sha384", "SHA384",
@@ -39,10 +61,15 @@ def get_algorithms():
         "dsa", "DSA",
         "md4", "MD4"
     ]
-    return [alg for alg in sorted_algs if alg in algorithms]
+    return tuple(alg for alg in sorted_algs if alg in algorithms)
 
+@lru_cache(maxsize=1)
 def get_address():
-    """Get this machine's address on the LAN"""
+    """Get this machine's address on the LAN
+
+    The lookup can take a DNS round trip, so the address is only looked up
+    once; call get_address.cache_clear() if it may have changed.
+    """
     import socket
     try:
         hostname = socket.gethostname()
@@ -50,34 +77,66 @@ def get_address():
         if '.' not in hostname:
             # if not, append .local, else we may get a loopback address
             hostname = '.'.join((hostname, "local"))
-        address = socket.gethostbyname(hostname)
+        address = socket.getaddrinfo(
+            hostname, None, socket.AF_INET, socket.SOCK_DGRAM
+        )[0][4][0]
     except:
         address = ""
     # if all else fails, "connect" to Google DNS and get the name of that socket
     if not address or address.startswith("127."):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 0))
-        address = s.getsockname()[0]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 0))
+            address = s.getsockname()[0]
     return address
 
+class StopFlag():
+    """StopFlag() -> StopFlag
+
+    This class is used to tell the servers, the event dispatcher, and the
+    device's main loop when to shut down. It has the same `set`/`is_set`
+    interface as threading.Event, but loops that poll it can read the
+    `stopped` attribute directly instead of making a method call.
+    """
+    __slots__ = ("stopped",)
+
+    def __init__(self):
+        self.stopped = False
+
+    def set(self):
+        """Signals everything that holds this flag to stop"""
+        self.stopped = True
+
+    def is_set(self):
+        """Returns True once `set` has been called"""
+        return self.stopped
+
 class Instant():
     """Instant() -> Instant
 
-    This class is used to keep track of the passing of time.
+    This class is used to keep track of the passing of time. `start` comes
+    from a monotonic clock, so it is only meaningful compared to other
+    Instants.
     """
     def __init__(self):
-        self.start = time()
+        self.start = perf_counter()
 
     def elapsed(self):
         """Returns the amount of time, in seconds, since the start of Instant"""
-        return time() - self.start
+        return perf_counter() - self.start
 
     def reset(self):
         """Sets the current time to the starting time of the Instant"""
-        self.start = time()
+        self.start = perf_counter()
 
     def __str__(self):
-        return str(timedelta(seconds=self.elapsed()))
+        # H:MM:SS.ffffff, like str(timedelta), without building a timedelta
+        elapsed = self.elapsed()
+        seconds = int(elapsed)
+        minutes, sec = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return "%d:%02d:%02d.%06d" % (
+            hours, minutes, sec, int((elapsed - seconds) * 1e6)
+        )
 
     def __repr__(self):
-        return repr(timedelta(seconds=self.elapsed()))
+        return "Instant(%s)" % self